@@ -0,0 +1,83 @@
+'''
+benchmark_patching.py: time patch extraction from a WSI with an increasing
+number of worker processes and compare per-patch reads against super-tile
+reads for overlapping grids
+'''
+
+import time
+import argparse
+
+from pyslide.slide import Slide
+from pyslide.patching import Patch
+
+
+def benchmark_workers(patch, workers):
+    '''
+    time a full pass of Patch.extract_patches for each worker count
+    Args:
+        patch: Patch object with generated patches
+        workers: list of worker counts
+    Returns:
+        results: list of (workers, seconds, patches/second)
+    '''
+    results=[]
+    for w in workers:
+        start=time.time()
+        num=sum(1 for _ in patch.extract_patches(workers=w))
+        elapsed=time.time()-start
+        results.append((w,elapsed,num/elapsed))
+        print('workers: {}, time: {:.2f}s, patches/s: {:.1f}, speedup: {:.2f}'.format(
+              w,elapsed,num/elapsed,results[0][1]/elapsed),flush=True)
+    return results
+
+
+def benchmark_supertile(patch, supertile=2**25):
+    '''
+    compare decoded bytes and wall time of per-patch reads against
+    super-tile reads. Decoded bytes count the RGBA pixels requested
+    from read_region, at the read size before any resampling
+    Args:
+        patch: Patch object with generated patches
+        supertile: max super-tile size in pixels
+    Returns:
+        results: list of (mode, seconds, decoded bytes)
+    '''
+    num=patch.number
+    per_patch=num*patch._read_size[0]*patch._read_size[1]*4
+    tiles=patch._supertiles(supertile)
+    super_bytes=sum(w*h*4 for _,_,_,w,h in tiles)
+    results=[]
+    for mode, kwargs, decoded in [('per-patch',{},per_patch),
+                                  ('supertile',{'supertile':supertile},super_bytes)]:
+        start=time.time()
+        n=sum(1 for _ in patch.extract_patches(**kwargs))
+        elapsed=time.time()-start
+        results.append((mode,elapsed,decoded))
+        print('{}: time: {:.2f}s, patches/s: {:.1f}, decoded: {:.1f}MB'.format(
+              mode,elapsed,n/elapsed,decoded/1e6),flush=True)
+    print('reads: {} vs {}, decoded ratio: {:.2f}, speedup: {:.2f}'.format(
+          num,len(tiles),per_patch/max(super_bytes,1),results[0][1]/results[1][1]))
+    return results
+
+
+if __name__=='__main__':
+
+    ap=argparse.ArgumentParser()
+    ap.add_argument('-wp','--wsipath',required=True,help='path to wsi')
+    ap.add_argument('-ml','--maglevel',default=0,type=int,help='magnification level')
+    ap.add_argument('-s','--size',default=512,type=int,help='patch size')
+    ap.add_argument('-st','--step',default=512,type=int,help='step size')
+    ap.add_argument('-w','--workers',default=[1,2,4,8],type=int,nargs='+',
+                    help='worker counts to benchmark')
+    ap.add_argument('-sp','--supertile',default=2**25,type=int,
+                    help='max super-tile pixels')
+    args=vars(ap.parse_args())
+
+    wsi=Slide(args['wsipath'])
+    border=[[0,wsi.dims[0]],[0,wsi.dims[1]]]
+    patch=Patch(wsi,size=(args['size'],args['size']),
+                mag_level=args['maglevel'],border=border)
+    num=patch.generate_patches(args['step'])
+    print('num patches: {}'.format(num))
+    benchmark_workers(patch,args['workers'])
+    benchmark_supertile(patch,args['supertile'])
@@ -23,6 +23,7 @@ SIZE=(1024,1024)
 SAVE_PATH='/home/verghese/test'
 WSI_PATH='/SAN/colcc/WSI_LymphNodes_BreastCancer/Greg/lymphnode-keras/data/wsi/Guys/wsi/all'
 ANNOTATIONS_PATH='/SAN/colcc/WSI_LymphNodes_BreastCancer/Greg/smuLymphNet/annotations'
+ANNOTATIONS_CACHE=os.path.join(ANNOTATIONS_PATH,'.cache')
 #FILTER_PATH='/SAN/colcc/WSI_LymphNodes_BreastCancer/Greg/lymphnode-keras/data/images'
 
 wsi_paths=glob.glob(os.path.join(WSI_PATH,'*'))
@@ -44,7 +45,8 @@ for p in wsi_paths:
     save_path=os.path.join(SAVE_PATH,name)
     os.makedirs(save_path,exist_ok=True)
 
-    annotate=Annotations(ann_path,source='qupath',labels=classes)
+    annotate=Annotations(ann_path,source='qupath',labels=classes,
+                       cache_dir=ANNOTATIONS_CACHE)
     annotations=annotate._annotations
     wsi=Slide(p,annotations=annotate)
     border=wsi.get_border(space=150)
@@ -78,38 +80,12 @@ for p in wsi_paths:
     #border=[[x*64,(x+w)*64],[y*64,(y+h)*64]]
 
     
-    #germinal centres
-    annotate_germs=Annotations(ann_path,source='qupath',labels=['GC'])
-    annotations=annotate_germs._annotations 
-    wsi_germs=Slide(p,annotations=annotate_germs)
-    
-    patches=Patch(wsi_germs,mag_level=MAG_LEVEL,border=border,size=SIZE)
-    num=patches.generate_patches(STEP)
-    #print('g','num patches: {}'.format(num))
-    #for p_idx in patches._patches:
-        #if p_idx['name'] not in filtered:
-            #patches._patches.remove(p_idx)
-    #test=[p_id for p_id in patches._patches if p_id['name'] in filtered]
-    #patches._patches=test
-    print('g','num patches: {}'.format(len(patches._patches)))
-    #print(patches._patches)
-    #patches.save(save_path,mask_flag=True)
-    #patches.save(save_path,mask_flag=True)
-    #patches.save_mask(save_path, 'mask')
-    """    
-    #sinuses
-    annotate_sinus=Annotations(ann_path,source='qupath',labels=['sinus'])
-    annotations=annotate_sinus._annotations 
-    wsi_sinus=Slide(p,annotations=annotate_sinus)
-    
-    patches=Patch(wsi_sinus,mag_level=MAG_LEVEL,border=border,size=SIZE)
+    #germinal centres and sinuses in one pass over the slide
+    patches=Patch(wsi,mag_level=MAG_LEVEL,border=border,size=SIZE)
     num=patches.generate_patches(STEP)
-    #test=[p_id for p_id in patches._patches if p_id['name'] in filtered]
-    #print('g','num patches: {}'.format(num))
-    #patches._patches=test
-    patches.save(save_path,mask_flag=True)
-    #patches.save_mask(save_path,'sinus_mask')
-
+    print('num patches: {}'.format(num))
+    patches.save(save_path,mask_flag=True,features=classes)
+    """
     #s=Stitching(os.path.join(save_path,'images'),mag_level=MAG_LEVEL,name=name)
     #canvas=s.stitch((2000,2000))
     #canvas=cv2.resize(canvas,(2000,2000))
@@ -61,7 +61,12 @@ class Slide():
         return len(self._lymphNodes)
 
 
-    def extractLymphNodes(self, germLabel, sinusLabel):
+    def extractLymphNodes(self, germLabel, sinusLabel, tissue=None):
+        #reuse a precomputed tissue mask (pyslide TissueMask) if given
+        if tissue is not None:
+            thresh=cv2.resize(tissue,(self.slide.shape[1],self.slide.shape[0]),
+                              interpolation=cv2.INTER_NEAREST)
+            return self._extractFromThresh(thresh,germLabel,sinusLabel)
 
         img_hsv=cv2.cvtColor(self.slide,cv2.COLOR_RGB2HSV)
         lower_red=np.array([120,0,0])
@@ -84,6 +89,10 @@ class Slide():
         #threshold twice
         _,thresh=cv2.threshold(blur_final,**Slide.thresh1_args)
         _,thresh=cv2.threshold(thresh,**Slide.thresh2_args)
+        return self._extractFromThresh(thresh,germLabel,sinusLabel)
+
+
+    def _extractFromThresh(self, thresh, germLabel, sinusLabel):
         #find contours
         contours,_=cv2.findContours(thresh,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_NONE)
         contours=list(filter(lambda x: cv2.contourArea(x) > 9000, contours))
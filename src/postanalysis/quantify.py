@@ -1,5 +1,6 @@
 import os
 import glob
+import json
 import argparse
 
 import numpy as np
@@ -20,6 +21,57 @@ def getFiles(filesPath, ext):
     return filesLst
 
 
+def slideSource(wsiF):
+    stat=os.stat(wsiF)
+    return stat.st_size,stat.st_mtime_ns
+
+
+def readSidecar(wsiF, level=6):
+    """
+    dimensions and level image from the pyslide sidecar
+    (<name>_meta/ next to the slide) when it is present and was
+    written for this version of the slide file, else from the slide
+    :param wsiF: slide path
+    :param level: pyramid level of the image
+    :return dims: level 0 (w,h)
+    :return levelDims: (w,h) of level
+    :return image: ndarray (h,w,3) uint8
+    """
+    stem=os.path.splitext(wsiF)[0]
+    metaPath=os.path.join(stem+'_meta','meta.json')
+    imagePath=os.path.join(stem+'_meta',f'level_{level}.npy')
+    if os.path.exists(metaPath) and os.path.exists(imagePath):
+        with open(metaPath) as f:
+            info=json.load(f)
+        size,mtime=slideSource(wsiF)
+        if info.get('source')=={'size':size,'mtime_ns':mtime}:
+            dims=tuple(info['dimensions'])
+            levelDims=tuple(info['level_dimensions'][level])
+            return dims,levelDims,np.load(imagePath)
+    wsi=openslide.OpenSlide(wsiF)
+    levelDims=wsi.level_dimensions[level]
+    image=np.array(wsi.get_thumbnail(size=levelDims).convert('RGB'))
+    return wsi.dimensions,levelDims,image
+
+
+def readTissue(wsiF, level=6):
+    """
+    tissue mask cached by pyslide's TissueMask next to the slide,
+    None if there is none for this version of the slide file. Never
+    detects or writes a mask itself
+    :param wsiF: slide path
+    :param level: pyramid level of the mask
+    :return tissue: ndarray (h,w) uint8 or None
+    """
+    path=os.path.splitext(wsiF)[0]+f'_tissue_{level}.npz'
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cached:
+        if tuple(cached['source'])!=slideSource(wsiF):
+            return None
+        return cached['mask']
+
+
 def analyseNodes(wsiPath,maskPath,savePath):
     cancerPts='/SAN/colcc/WSI_LymphNodes_BreastCancer/LNs/output/cancer_pred/Jules_Bordet/probs_map'
     print(maskPath)
@@ -105,8 +157,8 @@ def analyseNodes(wsiPath,maskPath,savePath):
         cancerCoords=list(zip(x,y))
         cancerCoords=[(int(c[1]),int(c[0])) for c in cancerCoords]
         mask = cv2.imread(maskF)
-        wsi=openslide.OpenSlide(wsiF)
-        dims=wsi.dimensions
+        #metadata and level 6 image from the pyslide sidecar if cached
+        dims,levelDims,image=readSidecar(wsiF,6)
         mdims=mask.shape
         
         #USING DOWNSCALED IMAGE
@@ -117,11 +169,8 @@ def analyseNodes(wsiPath,maskPath,savePath):
         #print(dims)
         #my,mx,_=dims
 
-        wsi=openslide.OpenSlide(wsiF)
-        dims_true=wsi.dimensions
-        image = wsi.get_thumbnail(size=(mdims[1],mdims[0]))
-        image=wsi.get_thumbnail(size=wsi.level_dimensions[6])
-        mx,my=wsi.level_dimensions[6]
+        dims_true=dims
+        mx,my=levelDims
         mask=cv2.resize(mask,(mx,my))
         #mask=mask[:,:,0]
 
@@ -145,8 +194,10 @@ def analyseNodes(wsiPath,maskPath,savePath):
         h=dims_true[0]
         wNew=mShape[0]
         hNew=mShape[1]
+        #tissue mask shared with pyslide if cached, else detected here
+        tissue=readTissue(wsiF,6)
         slide = me.Slide(image,mask,w,h,wNew,hNew)
-        num = slide.extractLymphNodes(255,128)
+        num = slide.extractLymphNodes(255,128,tissue=tissue)
         #f,ax=plt.subplots(1,2,figsize=(15,15))
         #ax[0].imshow(mask,cmap='gray')
         #ax[0].axis('off')
@@ -11,12 +11,195 @@ def image_entropy(patch):
     return avg_entr
 
 
+def _entropy(p, axis=-1):
+    """
+    shannon entropy in bits of probabilities along axis
+    """
+    logp=np.log2(np.where(p>0,p,1))
+    return 0.0-(p*logp).sum(axis=axis)
+
+
+def _gray(patch, downsample=1):
+    """
+    grey level patch shrunk by downsample
+    """
+    gray=cv2.cvtColor(patch,cv2.COLOR_RGB2GRAY)
+    if downsample>1:
+        size=(max(gray.shape[1]//downsample,1),max(gray.shape[0]//downsample,1))
+        gray=cv2.resize(gray,size,interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def _histogram_entropies(grays, bins=256):
+    """
+    histogram entropy of each row of grey levels
+    :param grays: ndarray (n,pixels) uint8
+    :return entropies: ndarray (n,) float bits
+    """
+    n=len(grays)
+    q=(grays.astype(np.int64)*bins)>>8
+    hist=np.bincount((q+bins*np.arange(n)[:,None]).ravel(),
+                     minlength=n*bins).reshape(n,bins)
+    return _entropy(hist/hist.sum(axis=1,keepdims=True))
+
+
+def histogram_entropy(patch, downsample=4, bins=256):
+    """
+    entropy of the grey level histogram of a downsampled patch
+    :param patch: ndarray RGB patch
+    :param downsample: patch shrink factor
+    :param bins: number of grey level bins
+    :return entropy: float bits
+    """
+    gray=_gray(patch,downsample)
+    return float(_histogram_entropies(gray.reshape(1,-1),bins)[0])
+
+
+def box_entropy(patch, radius=10, bins=16, stride=4):
+    """
+    mean local entropy over square windows, the box analogue of
+    rank entropy with a disk. Window histograms come from one
+    running sum per grey level bin and are evaluated every stride
+    pixels
+    :param patch: ndarray RGB patch
+    :param radius: window radius
+    :param bins: number of grey level bins
+    :param stride: spacing of evaluated window centres
+    :return entropy: float bits
+    """
+    gray=cv2.cvtColor(patch,cv2.COLOR_RGB2GRAY)
+    q=(gray.astype(np.int32)*bins)>>8
+    ksize=(2*radius+1,2*radius+1)
+    #windows are clipped to the patch as rank entropy does
+    area=cv2.boxFilter(np.ones(gray.shape,np.float32),-1,ksize,normalize=False,
+                       borderType=cv2.BORDER_CONSTANT)[::stride,::stride]
+    total=np.zeros(area.shape,dtype=np.float64)
+    for b in range(bins):
+        count=cv2.boxFilter((q==b).astype(np.float32),-1,ksize,normalize=False,
+                            borderType=cv2.BORDER_CONSTANT)[::stride,::stride]
+        p=count/area
+        total-=p*np.log2(np.where(p>0,p,1))
+    return float(total.mean())
+
+
+def batch_entropy(patches, method='histogram', **kwargs):
+    """
+    entropy of a batch of patches. histogram entropies are counted
+    for the whole batch in one bincount
+    :param patches: ndarray (n,h,w,3) RGB patches
+    :param method: histogram, box or rank (image_entropy)
+    :param kwargs: arguments of histogram_entropy or box_entropy
+    :return entropies: ndarray (n,) float
+    """
+    patches=np.asarray(patches)
+    if method=='histogram':
+        downsample=kwargs.get('downsample',4)
+        grays=np.stack([_gray(p,downsample).ravel() for p in patches])
+        return _histogram_entropies(grays,kwargs.get('bins',256))
+    elif method=='box':
+        return np.array([box_entropy(p,**kwargs) for p in patches])
+    elif method=='rank':
+        return np.array([image_entropy(p) for p in patches])
+    raise ValueError(f'unknown entropy method {method}')
+
+
+def entropy_agreement(patches, threshold, method='histogram', **kwargs):
+    """
+    compare a fast entropy method against image_entropy. The fast
+    threshold is the quantile of the fast metric that removes as
+    many patches as threshold does on image_entropy
+    :param patches: ndarray (n,h,w,3) RGB patches
+    :param threshold: image_entropy threshold, patches below are removed
+    :param method: histogram or box
+    :param kwargs: arguments of the fast method
+    :return report: dict with correlation, rank_correlation,
+        threshold (matched fast threshold) and agreement (fraction of
+        identical keep decisions)
+    """
+    reference=batch_entropy(patches,'rank')
+    fast=batch_entropy(patches,method,**kwargs)
+    keep=reference>=threshold
+    fast_threshold=np.quantile(fast,1-keep.mean()) if keep.any() else np.inf
+    rank=lambda a: np.argsort(np.argsort(a))
+    return {'correlation':float(np.corrcoef(reference,fast)[0,1]),
+            'rank_correlation':float(np.corrcoef(rank(reference),rank(fast))[0,1]),
+            'threshold':float(fast_threshold),
+            'agreement':float(((fast>=fast_threshold)==keep).mean())}
+
+
+def black_fraction(patch, threshold=110):
+    """
+    fraction of pixels darker than threshold
+    :param patch: ndarray RGB patch
+    :param threshold: grey level threshold
+    :return fraction: float
+    """
+    gray=cv2.cvtColor(patch,cv2.COLOR_RGB2GRAY)
+    return float((gray<threshold).mean())
+
+
 def remove_black(patch,
                  threshold=110,
                  max_value=255,
                  area_thresh=0.2):
-    gray=cv2.cvtColor(image,cv2.COLOR_RGBGRAY)
-    _,thresh=cv2.threshold(image,threshold,max_value,cv2.THRESH_BINARY)
-    _,counts=np.unique(thresh,return_counts=True)
-    area_proportion=counts[0]/counts[0]+counts[1]
-    return area_proportion
+    """
+    True when more than area_thresh of the patch is darker
+    than threshold
+    """
+    return black_fraction(patch,threshold)>area_thresh
+
+
+def laplacian_variance(patch):
+    """
+    blur score, low for out of focus patches
+    :param patch: ndarray RGB patch
+    :return variance: float
+    """
+    gray=cv2.cvtColor(patch,cv2.COLOR_RGB2GRAY)
+    return float(cv2.Laplacian(gray,cv2.CV_64F).var())
+
+
+#metrics computed by patch_metrics in this order
+QC_METRICS=['mean_r','mean_g','mean_b','std_r','std_g','std_b',
+            'background','black','pen','blur','entropy']
+
+
+def patch_metrics(patch, 
+                  metrics=None, 
+                  entropy_method='histogram',
+                  saturation=20, 
+                  black=110,
+                  pen_hue=(35,130),
+                  pen_saturation=60):
+    """
+    QC metrics of one patch, sharing the HSV conversion between
+    background and pen marks
+    :param patch: ndarray RGB patch
+    :param metrics: names from QC_METRICS, defaults to all
+    :param entropy_method: histogram, box or rank
+    :param saturation: HSV saturation below which a pixel is background
+    :param black: grey level below which a pixel is black
+    :param pen_hue: OpenCV hue range (0-180) of blue/green ink
+    :param pen_saturation: min saturation of ink pixels
+    :return values: dict {metric:float}
+    """
+    metrics=QC_METRICS if metrics is None else metrics
+    values={}
+    if any(m.startswith(('mean','std')) for m in metrics):
+        mean,std=cv2.meanStdDev(patch)
+        for i, c in enumerate('rgb'):
+            values['mean_'+c]=float(mean[i,0])
+            values['std_'+c]=float(std[i,0])
+    if 'background' in metrics or 'pen' in metrics:
+        hsv=cv2.cvtColor(patch,cv2.COLOR_RGB2HSV)
+        values['background']=float((hsv[:,:,1]<saturation).mean())
+        pen=((hsv[:,:,0]>=pen_hue[0])&(hsv[:,:,0]<=pen_hue[1])
+             &(hsv[:,:,1]>=pen_saturation))
+        values['pen']=float(pen.mean())
+    if 'black' in metrics:
+        values['black']=black_fraction(patch,black)
+    if 'blur' in metrics:
+        values['blur']=laplacian_variance(patch)
+    if 'entropy' in metrics:
+        values['entropy']=float(batch_entropy(patch[None],entropy_method)[0])
+    return {m:values[m] for m in metrics}
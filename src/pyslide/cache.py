@@ -0,0 +1,305 @@
+"""
+cache.py: contains 1. RegionCache class 2. SlideMeta class
+
+RegionCache class - byte bounded LRU cache of decoded slide blocks.
+Blocks are aligned squares on each pyramid level's own pixel grid and
+read_region requests are served by composing the blocks they overlap,
+so a second pass over the same regions costs memory copies instead of
+decodes.
+
+SlideMeta class - sidecar directory next to a slide holding its
+dimensions, level info, mpp and properties as json plus thumbnails as
+.npy files. Later uses read the sidecar instead of opening the slide
+and decoding thumbnails again.
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import openslide
+from openslide import OpenSlide
+
+from pyslide.util.fileio import atomic_write
+
+__author__='Gregory Verghese'
+__email__='gregory.verghese@gmail.com'
+
+
+class RegionCache():
+    """
+    LRU cache of RGBA blocks keyed by (level,block_x,block_y).
+
+    :param read: function (location,level,size) -> PIL RGBA image used
+        to decode missing blocks
+    :param max_bytes: cache size limit in bytes
+    :param block: block side in level pixels
+    """
+    def __init__(self, read, max_bytes=2**30, block=1024):
+        self.read=read
+        self.max_bytes=max_bytes
+        self.block=block
+        self.hits=0
+        self.misses=0
+        self.nbytes=0
+        self._blocks=OrderedDict()
+        self._lock=threading.Lock()
+
+
+    def __len__(self):
+        return len(self._blocks)
+
+
+    def __repr__(self):
+        return f'RegionCache(blocks: {len(self)}, bytes: {self.nbytes}, hits: {self.hits}, misses: {self.misses})'
+
+
+    @property
+    def info(self):
+        return {'hits':self.hits,'misses':self.misses,'blocks':len(self),
+                'bytes':self.nbytes,'max_bytes':self.max_bytes}
+
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.nbytes=0
+            self.hits=0
+            self.misses=0
+
+
+    def _get(self, level, bx, by, downsample):
+        """
+        cached block, decoded and inserted on a miss
+        :param level: pyramid level
+        :param bx: block column on level grid
+        :param by: block row on level grid
+        :param downsample: level downsample
+        :return block: ndarray (block,block,4) uint8
+        """
+        key=(level,bx,by)
+        with self._lock:
+            block=self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                self.hits+=1
+                return block
+            self.misses+=1
+        location=(int(bx*self.block*downsample),int(by*self.block*downsample))
+        block=np.asarray(self.read(location,level,(self.block,self.block)))
+        with self._lock:
+            if key not in self._blocks:
+                self._blocks[key]=block
+                self.nbytes+=block.nbytes
+            while self.nbytes>self.max_bytes and len(self._blocks)>1:
+                _,old=self._blocks.popitem(last=False)
+                self.nbytes-=old.nbytes
+        return block
+
+
+    def region(self, x, y, w, h, level, downsample):
+        """
+        compose RGBA region from cached blocks
+        :param x: int x coordinate on level grid
+        :param y: int y coordinate on level grid
+        :param w: int region width
+        :param h: int region height
+        :param level: pyramid level
+        :param downsample: level downsample
+        :return region: ndarray (h,w,4) uint8
+        """
+        b=self.block
+        region=np.empty((h,w,4),dtype=np.uint8)
+        for by in range(y//b,(y+h-1)//b+1):
+            for bx in range(x//b,(x+w-1)//b+1):
+                block=self._get(level,bx,by,downsample)
+                x1,y1=max(x,bx*b),max(y,by*b)
+                x2,y2=min(x+w,(bx+1)*b),min(y+h,(by+1)*b)
+                region[y1-y:y2-y,x1-x:x2-x]=block[y1-by*b:y2-by*b,x1-bx*b:x2-bx*b]
+        return region
+
+
+class SlideMeta():
+    """
+    Per slide metadata and thumbnail sidecar. The slide is only
+    opened when the sidecar is missing or older than the slide file.
+
+    :param path: slide file path
+    :param cache_dir: directory for sidecars. Defaults to a
+        directory next to the slide
+    :param slide: open OpenSlide/pyslide.Slide handle to use
+        instead of opening the file
+    """
+    def __init__(self, path, cache_dir=None, slide=None):
+        self.path=path
+        name=os.path.splitext(os.path.basename(path))[0]+'_meta'
+        if cache_dir is None:
+            cache_dir=os.path.dirname(os.path.abspath(path))
+        self.dir=os.path.join(cache_dir,name)
+        self._slide=slide
+        self._info=None
+        self._arrays={}
+
+
+    def __repr__(self):
+        return f'SlideMeta(path: {self.path}, sidecar: {self.dir})'
+
+
+    @property
+    def slide(self):
+        if self._slide is None:
+            self._slide=OpenSlide(self.path)
+        return self._slide
+
+
+    @property
+    def source(self):
+        """
+        size and modification time of the slide file, stored with
+        the sidecar to detect stale entries
+        """
+        stat=os.stat(self.path)
+        return {'size':stat.st_size,'mtime_ns':stat.st_mtime_ns}
+
+
+    @property
+    def info(self):
+        """
+        slide metadata, read from the sidecar or built from the slide
+        :return info: dict
+        """
+        if self._info is None:
+            self._info=self._load()
+        if self._info is None:
+            self._info=self._build()
+            self._write('meta.json',lambda f: json.dump(self._info,f),'w')
+        return self._info
+
+
+    def _load(self):
+        path=os.path.join(self.dir,'meta.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            info=json.load(f)
+        if info.get('source')!=self.source:
+            self._arrays={}
+            for f in os.listdir(self.dir):
+                try:
+                    os.remove(os.path.join(self.dir,f))
+                except OSError:
+                    pass
+            return None
+        return info
+
+
+    def _build(self):
+        slide=self.slide
+        properties=dict(slide.properties)
+        mpp=properties.get(openslide.PROPERTY_NAME_MPP_X)
+        return {'source':self.source,
+                'dimensions':list(slide.dimensions),
+                'level_count':slide.level_count,
+                'level_dimensions':[list(d) for d in slide.level_dimensions],
+                'level_downsamples':list(slide.level_downsamples),
+                'mpp':None if mpp is None else float(mpp),
+                'properties':properties}
+
+
+    def _write(self, name, dump, mode='wb'):
+        """
+        write sidecar file via a temporary file renamed into place.
+        Read-only slide directories are skipped silently
+        :param name: file name in sidecar directory
+        :param dump: function writing to an open file
+        :param mode: file mode
+        """
+        try:
+            os.makedirs(self.dir,exist_ok=True)
+            atomic_write(os.path.join(self.dir,name),dump,mode)
+        except OSError:
+            pass
+
+
+    @property
+    def dimensions(self):
+        return tuple(self.info['dimensions'])
+
+
+    @property
+    def level_count(self):
+        return self.info['level_count']
+
+
+    @property
+    def level_dimensions(self):
+        return tuple(tuple(d) for d in self.info['level_dimensions'])
+
+
+    @property
+    def level_downsamples(self):
+        return tuple(self.info['level_downsamples'])
+
+
+    @property
+    def mpp(self):
+        return self.info['mpp']
+
+
+    @property
+    def properties(self):
+        return self.info['properties']
+
+
+    def _array(self, name, compute):
+        """
+        cached array, loaded from the sidecar or computed and saved
+        :param name: file name in sidecar directory
+        :param compute: function returning the array
+        :return array: ndarray
+        """
+        if name not in self._arrays:
+            self.info
+            path=os.path.join(self.dir,name)
+            if os.path.exists(path):
+                array=np.load(path)
+            else:
+                array=compute()
+                self._write(name,lambda f: np.save(f,array))
+            self._arrays[name]=array
+        return self._arrays[name]
+
+
+    def level_array(self, level, background=True):
+        """
+        whole pyramid level as RGB, as get_thumbnail returns for the
+        level's own dimensions
+        :param level: pyramid level
+        :param background: False composites transparent pixels on
+            black instead of the slide background colour
+        :return image: ndarray (h,w,3) uint8
+        """
+        def compute():
+            if hasattr(self.slide,'_read_level_array'):
+                return self.slide._read_level_array(level,background)
+            dims=self.slide.level_dimensions[level]
+            if background:
+                return np.array(self.slide.get_thumbnail(dims).convert('RGB'))
+            image=np.array(self.slide.read_region((0,0),level,dims))
+            alpha=image[...,3:].astype(np.uint16)
+            return (image[...,:3]*alpha//255).astype(np.uint8)
+        name=f'level_{level}.npy' if background else f'level_{level}_black.npy'
+        return self._array(name,compute)
+
+
+    def thumbnail(self, size):
+        """
+        RGB thumbnail fitting inside size
+        :param size: (w,h) maximum thumbnail size
+        :return image: ndarray (h,w,3) uint8
+        """
+        def compute():
+            return np.array(self.slide.get_thumbnail(size).convert('RGB'))
+        return self._array(f'thumbnail_{size[0]}x{size[1]}.npy',compute)
@@ -31,12 +31,18 @@ class LMDBWrite():
         print(f'\r- Progress: {complete:.1%}', end='\r')
 
 
-    def write(self,patch): 
+    def write(self,patch,workers=None,threads=None,context=None): 
         txn=self.env.begin(write=True)
-        for i, (image, p) in enumerate(patch.extract_patches()):
-            value=self._serialize(image)
-            key = f"{p['name']}"
-            txn.put(key.encode("ascii"), pickle.dumps(value))
+        if context is not None:
+            patches=patch.extract_contexts(context,threads)
+        else:
+            patches=(([image],p) for image,p in patch.extract_patches(workers,threads=threads))
+        for i, (images, p) in enumerate(patches):
+            #context patches go in the same transaction as their patch
+            keys=[f"{p['name']}"]+[f"{p['name']}_context_{f}" for f in context or []]
+            for key, image in zip(keys,images):
+                value=self._serialize(image)
+                txn.put(key.encode("ascii"), pickle.dumps(value))
             self._print_progress(i,len(patch._patches))
             if i % self.write_frequency == 0:
                 txn.commit()
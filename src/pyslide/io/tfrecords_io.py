@@ -1,5 +1,4 @@
 import os
-import sys
 import json
 import glob
 import argparse
@@ -15,16 +14,22 @@ class TFRecordWrite():
                  db_path,
                  patch,
                  shard_size=0.01,
-                 unit=10**9):
+                 unit=10**9,
+                 workers=None,
+                 threads=None,
+                 context=None):
 
         self.db_path=db_path
         self.patch=patch
         self.shard_size=0.01 
         self.unit=10**9
+        self.workers=workers
+        self.threads=threads
+        self.context=context
 
     
-    def _print_progress(self,i):
-        complete = float(i)/self.img_num_per_shard
+    def _print_progress(self,i,total):
+        complete = float(i)/total
         print(f'\r- Progress: {complete:.1%}', end='\r')
 
     
@@ -42,9 +47,13 @@ class TFRecordWrite():
     
     @property
     def mem_size(self):
-        mem = sum(sys.getsizeof(p.tobytes()) 
-                        for p,_ in self.patch.extract_patches())
-        return mem/self.unit
+        """
+        uncompressed size of all patches (and contexts) in units,
+        from the patch count and size without reading pixels
+        """
+        w,h=self.patch.size[0],self.patch.size[1]
+        images=1+len(self.context or [])
+        return len(self.patch._patches)*w*h*3*images/self.unit
 
 
     @property
@@ -58,20 +67,32 @@ class TFRecordWrite():
 
 
     def convert(self): 
-        for i in range(self.shard_number):
+        if self.context is not None:
+            patches=self.patch.extract_contexts(self.context,self.threads)
+        else:
+            patches=self.patch.extract_patches(self.workers,threads=self.threads)
+        shard_number=self.shard_number
+        img_num_per_shard=self.img_num_per_shard
+        for i in range(shard_number):
             path=os.path.join(self.db_path,str(i)+'.tfrecords')
             writer=tf.io.TFRecordWriter(path)
-            for j in range(self.img_num_per_shard):
-                image, p = next(self.patch.extract_patches())
-                self._print_progress(j)
+            for j in range(img_num_per_shard):
+                image, p = next(patches)
+                self._print_progress(j,img_num_per_shard)
+                contexts=[]
+                if self.context is not None:
+                    image, contexts = image[0], image[1:]
                 image = tf.image.encode_png(image)
                  
                 data = {'image': self._wrap_bytes(image),
                          'name': self._wrap_bytes(p['name'].encode('utf8')),
                          'dims': self._wrap_int64(self.patch.size[0])}
+                for f, c in zip(self.context or [],contexts):
+                    data[f'context_{f}']=self._wrap_bytes(tf.image.encode_png(c))
                
                 features = tf.train.Features(feature=data)
                 example = tf.train.Example(features=features)
                 serialized = example.SerializeToString()
                 writer.write(serialized)
+            writer.close()
 
@@ -0,0 +1,322 @@
+"""
+mask.py: contains 1. MaskPyramid class 2. TissueMask class
+
+MaskPyramid class - annotation mask pyramid matching the slide's own
+level_downsamples. Each level is rasterized directly at its resolution
+on first use and persisted as a memory-mapped uint8 .npy file so any
+later read, from any process, is a slice of a memmap.
+
+TissueMask class - low resolution binary tissue mask computed once per
+slide, cached on disk and backed by an integral image for tissue
+fraction queries over level 0 rectangles.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import cv2
+import numpy as np
+
+from pyslide.util.fileio import share_mode, atomic_write
+
+__author__='Gregory Verghese'
+__email__='gregory.verghese@gmail.com'
+
+
+class MaskPyramid():
+    """
+    Lazily materialized memory-mapped annotation mask pyramid.
+
+    :param slide: pyslide.Slide object with annotations
+    :param path: directory for mask files. Defaults to a directory
+        next to the slide file
+    :param band: rows rasterized at a time when building a level
+    """
+    def __init__(self, slide, path=None, band=4096):
+        self.slide=slide
+        if path is None:
+            path=os.path.splitext(slide.path)[0]+'_masks'
+        self.path=os.path.join(path,self.key)
+        self.band=band
+        self._levels={}
+
+
+    def __repr__(self):
+        return f'MaskPyramid(levels: {sorted(self._levels)}, path: {self.path})'
+
+
+    @property
+    def key(self):
+        """
+        hash of annotation content so stale masks are never reused
+        :return key: str
+        """
+        annotations=self.slide.annotations
+        h=hashlib.sha1(json.dumps(annotations.labels).encode('utf-8'))
+        for a in (annotations._coords,annotations._offsets,annotations._label_ids):
+            h.update(np.ascontiguousarray(a).tobytes())
+        return h.hexdigest()[:16]
+
+
+    def _level_path(self, level):
+        return os.path.join(self.path,f'level_{level}.npy')
+
+
+    def level(self, level):
+        """
+        memory-mapped mask at pyramid level, built if missing
+        :param level: slide pyramid level
+        :return mask: read-only np.memmap (h,w) uint8
+        """
+        if level not in self._levels:
+            path=self._level_path(level)
+            if not os.path.exists(path):
+                self._build(level)
+            self._levels[level]=np.load(path,mmap_mode='r')
+        return self._levels[level]
+
+
+    def _build(self, level):
+        """
+        rasterize level in row bands into a temporary memmap and
+        rename into place once complete
+        :param level: slide pyramid level
+        """
+        os.makedirs(self.path,exist_ok=True)
+        w,h=self.slide.level_dimensions[level]
+        downsample=self.slide.level_downsamples[level]
+        fd,tmp_path=tempfile.mkstemp(suffix='.npy',dir=self.path)
+        os.close(fd)
+        try:
+            mask=np.lib.format.open_memmap(tmp_path,mode='w+',
+                                           dtype=np.uint8,shape=(h,w))
+            for y in range(0,h,self.band):
+                band_h=min(self.band,h-y)
+                mask[y:y+band_h]=self.slide._rasterize(0,y*downsample,w,band_h,downsample)
+            mask.flush()
+            del mask
+            share_mode(tmp_path)
+            os.replace(tmp_path,self._level_path(level))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+    def region(self, x, y, w, h, level=0):
+        """
+        mask window at level. A view into the memmap unless the
+        window extends past the slide, then a zero padded copy
+        :param x: int level 0 x coordinate of window
+        :param y: int level 0 y coordinate of window
+        :param w: int window width at level
+        :param h: int window height at level
+        :param level: pyramid level
+        :return mask: ndarray (h,w) uint8
+        """
+        mask=self.level(level)
+        downsample=self.slide.level_downsamples[level]
+        x=int(round(x/downsample))
+        y=int(round(y/downsample))
+        if x>=0 and y>=0 and x+w<=mask.shape[1] and y+h<=mask.shape[0]:
+            return mask[y:y+h,x:x+w]
+        region=np.zeros((h,w),dtype=np.uint8)
+        x1,y1=max(x,0),max(y,0)
+        x2,y2=min(x+w,mask.shape[1]),min(y+h,mask.shape[0])
+        if x2>x1 and y2>y1:
+            region[y1-y:y2-y,x1-x:x2-x]=mask[y1:y2,x1:x2]
+        return region
+
+
+class TissueMask():
+    """
+    Binary tissue mask detected on a low resolution level of the
+    slide. Saved next to the slide with the slide file's size and
+    modification time and the detection parameters, and reloaded on
+    later use while all of them still match.
+
+    :param slide: pyslide.Slide or openslide.OpenSlide object
+    :param level: pyramid level to detect tissue on
+    :param path: cache file path. Defaults to cache_path, no
+        caching if slide path is unknown. Unwritable paths are
+        skipped and the mask recomputed next time
+    :param cache_dir: directory for the cache file, defaults to
+        the slide's directory
+    :param mask: ndarray uint8 mask (255 tissue)
+    :param downsample: level 0 pixels per mask pixel
+    """
+    bilateral1_args={"d":9,"sigmaColor":10000,"sigmaSpace":150}
+    bilateral2_args={"d":90,"sigmaColor":5000,"sigmaSpace":5000}
+    bilateral3_args={"d":90,"sigmaColor":10000,"sigmaSpace":10000}
+    bilateral4_args={"d":90,"sigmaColor":10000,"sigmaSpace":100}
+    thresh1_args={"thresh":0,"maxval":255,"type":cv2.THRESH_TRUNC+cv2.THRESH_OTSU}
+    thresh2_args={"thresh":0,"maxval":255,"type":cv2.THRESH_OTSU}
+    lower_red=[120,0,0]
+    upper_red=[180,255,255]
+    fill=233
+
+    def __init__(self, slide, level=6, path=None, cache_dir=None):
+        level=min(level,slide.level_count-1)
+        self.level=level
+        self.downsample=slide.level_downsamples[level]
+        if path is None and hasattr(slide,'path'):
+            path=TissueMask.cache_path(slide.path,level,cache_dir)
+        self.path=path
+
+        self.source=None
+        if path is not None:
+            self.source=TissueMask.slide_source(slide.path)
+        self.mask=None
+        if path is not None and os.path.exists(path):
+            self.mask=self._load(path)
+        if self.mask is None:
+            if hasattr(slide,'read_level_array'):
+                image=slide.read_level_array(level)
+            elif hasattr(slide,'level_array'):
+                image=slide.level_array(level)
+            else:
+                image=slide.get_thumbnail(slide.level_dimensions[level])
+                image=np.array(image.convert('RGB'))
+            self.mask=TissueMask.detect(image)
+            if path is not None:
+                self._save(path)
+        self._sat=cv2.integral((self.mask>0).astype(np.uint8))
+
+
+    def __repr__(self):
+        return f'TissueMask(level: {self.level}, shape: {self.mask.shape}, tissue: {self.fraction():.1%})'
+
+
+    @staticmethod
+    def cache_path(slide_path, level=6, cache_dir=None):
+        """
+        tissue mask cache file of a slide
+        :param slide_path: slide file path
+        :param level: pyramid level of the mask
+        :param cache_dir: directory, defaults to the slide's directory
+        :return path: str
+        """
+        name=os.path.splitext(os.path.basename(slide_path))[0]+f'_tissue_{level}.npz'
+        if cache_dir is None:
+            cache_dir=os.path.dirname(os.path.abspath(slide_path))
+        return os.path.join(cache_dir,name)
+
+
+    @staticmethod
+    def slide_source(slide_path):
+        """
+        size and modification time of the slide file
+        :return source: ndarray int64 [size,mtime_ns]
+        """
+        stat=os.stat(slide_path)
+        return np.array([stat.st_size,stat.st_mtime_ns],dtype=np.int64)
+
+
+    @classmethod
+    def params(cls):
+        """
+        detection parameters stored with the mask
+        :return params: str json
+        """
+        return json.dumps([cls.lower_red,cls.upper_red,cls.fill,
+                           cls.bilateral1_args,cls.bilateral2_args,
+                           cls.bilateral3_args,cls.bilateral4_args,
+                           cls.thresh1_args,cls.thresh2_args],sort_keys=True)
+
+
+    def _load(self, path):
+        """
+        cached mask, None if the slide or detection parameters
+        changed since it was saved
+        """
+        with np.load(path) as cached:
+            if (np.array_equal(cached['source'],self.source)
+                and str(cached['params'])==self.params()):
+                return cached['mask']
+        return None
+
+
+    def _save(self, path):
+        """
+        write mask via a temporary file renamed into place. Read-only
+        slide directories are skipped silently
+        """
+        try:
+            atomic_write(path,lambda f: np.savez(f,mask=self.mask,
+                                                  source=self.source,
+                                                  params=np.array(self.params())))
+        except OSError:
+            pass
+
+
+    @staticmethod
+    def detect(image):
+        """
+        detect tissue on RGB thumbnail. Keeps red/purple hues then
+        links stained regions with repeated bilateral filtering
+        before double Otsu thresholding
+        :param image: ndarray RGB thumbnail
+        :return thresh: ndarray uint8 mask (255 tissue)
+        """
+        img_hsv=cv2.cvtColor(image,cv2.COLOR_RGB2HSV)
+        lower_red=np.array(TissueMask.lower_red)
+        upper_red=np.array(TissueMask.upper_red)
+        mask=cv2.inRange(img_hsv,lower_red,upper_red)
+        m=cv2.bitwise_and(image,image,mask=mask)
+        im_fill=np.where(m==0,TissueMask.fill,m).astype(np.uint8)
+        gray=cv2.cvtColor(im_fill,cv2.COLOR_BGR2GRAY)
+        blur1=cv2.bilateralFilter(np.bitwise_not(gray),**TissueMask.bilateral1_args)
+        blur2=cv2.bilateralFilter(np.bitwise_not(blur1),**TissueMask.bilateral2_args)
+        blur3=cv2.bilateralFilter(np.bitwise_not(blur2),**TissueMask.bilateral3_args)
+        blur4=cv2.bilateralFilter(np.bitwise_not(blur3),**TissueMask.bilateral4_args)
+        blur_final=255-blur4
+        _,thresh=cv2.threshold(blur_final,**TissueMask.thresh1_args)
+        _,thresh=cv2.threshold(thresh,**TissueMask.thresh2_args)
+        return thresh
+
+
+    def contours(self, min_area=0):
+        """
+        external tissue contours at mask resolution
+        :param min_area: minimum contour area in mask pixels
+        :return contours: list of contours
+        """
+        contours,_=cv2.findContours(self.mask,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_NONE)
+        return [c for c in contours if cv2.contourArea(c)>min_area]
+
+
+    def fractions(self, xs, ys, w, h):
+        """
+        tissue fraction inside level 0 rectangles, four integral
+        image lookups per rectangle
+        :param xs: level 0 x coordinates
+        :param ys: level 0 y coordinates
+        :param w: level 0 rectangle width
+        :param h: level 0 rectangle height
+        :return fractions: ndarray float
+        """
+        rows,cols=self.mask.shape
+        xs=np.asarray(xs,dtype=np.float64)/self.downsample
+        ys=np.asarray(ys,dtype=np.float64)/self.downsample
+        x1=np.clip(np.floor(xs),0,cols).astype(np.int64)
+        y1=np.clip(np.floor(ys),0,rows).astype(np.int64)
+        x2=np.clip(np.ceil(xs+w/self.downsample),0,cols).astype(np.int64)
+        y2=np.clip(np.ceil(ys+h/self.downsample),0,rows).astype(np.int64)
+        s=self._sat
+        tissue=s[y2,x2]-s[y1,x2]-s[y2,x1]+s[y1,x1]
+        area=(x2-x1)*(y2-y1)
+        return np.where(area>0,tissue/np.maximum(area,1),0.0)
+
+
+    def fraction(self, x=0, y=0, w=None, h=None):
+        """
+        tissue fraction inside a level 0 rectangle. Defaults to
+        the whole slide
+        :return fraction: float
+        """
+        if w is None:
+            w=self.mask.shape[1]*self.downsample
+        if h is None:
+            h=self.mask.shape[0]*self.downsample
+        return float(self.fractions([x],[y],w,h)[0])
@@ -14,6 +14,9 @@ import os
 import glob
 import json
 import random
+import zlib
+import multiprocessing as mp
+from collections import deque
 
 import numpy as np
 import cv2
@@ -26,15 +29,63 @@ import seaborn as sns
 from itertools import chain
 import operator as op
 
+from pyslide.slide import Slide
+from pyslide.pool import SlidePool
 from pyslide.util.utilities import mask2rgb
 from pyslide.exceptions import StitchingMissingPatches
-from pyslide.analysis.filters import image_entropy
-from pyslide.io.lmdb_io import LMDBWrite
-from pyslide.io.tfrecords_io import TFRecordWrite
+from pyslide.table import PatchTable
+from pyslide.analysis.filters import image_entropy, batch_entropy
+from pyslide.analysis.filters import patch_metrics, QC_METRICS
 
 __author__='Gregory Verghese'
 __email__='gregory.verghese@gmail.com'
 
+#slide handle opened once in each extraction worker process
+_worker_slide=None
+
+
+def _init_worker(path, annotations, pyramid_path):
+    """
+    open a slide handle per worker process
+    :param path: slide file path
+    :param annotations: Annotations object or None
+    :param pyramid_path: MaskPyramid directory or None
+    """
+    global _worker_slide
+    _worker_slide=Slide(path,annotations=annotations)
+    if pyramid_path is not None:
+        _worker_slide.build_mask_pyramid(pyramid_path)
+
+
+def _extract_chunk(args):
+    """
+    read a contiguous chunk of patches in a worker
+    :param args: (xs,ys,level,read_size,size)
+    :return patches: ndarray (n,h,w,3) patches
+    """
+    xs,ys,level,read_size,size=args
+    return _worker_slide.read_regions_array(list(zip(xs.tolist(),ys.tolist())),
+                                            level,read_size,resize=size)
+
+
+def _save_chunk(args):
+    """
+    read and save a contiguous chunk of patches (and masks) in a worker
+    :param args: (xs,ys,level,read_size,size,mask_downsample,
+        patch_path,mask_dirs,features,filename)
+    :return num: number of patches saved
+    """
+    (xs,ys,level,read_size,size,mask_downsample,
+     patch_path,mask_dirs,features,filename)=args
+    patch=np.empty((size[1],size[0],3),dtype=np.uint8)
+    for x, y in zip(xs.tolist(),ys.tolist()):
+        _worker_slide.read_region_array((x,y),level,read_size,patch,resize=size)
+        Patch._save_disk(patch,patch_path,filename,x,y)
+        if mask_dirs:
+            Patch._save_masks(_worker_slide,x,y,size,level,mask_downsample,
+                              features,mask_dirs,filename)
+    return len(xs)
+
 
 class Patch():
     def __init__(self, 
@@ -42,12 +93,20 @@ class Patch():
                  size, 
                  mag_level=0,
                  border=None,  
-                 step=None):
+                 step=None,
+                 mpp=None):
 
         super().__init__()
         self.slide = slide
+        self.mpp = mpp
+        if mpp is not None:
+            mag_level,self._residual=slide.level_for_mpp(mpp)
+        else:
+            self._residual=1.0
         self.mag_level = mag_level
         self.size = size
+        self._read_size=(int(round(size[0]*self._residual)),
+                         int(round(size[1]*self._residual)))
         self.border = slide._border if border is None else border
         self._x_min = int(self.border[0][0])
         self._x_max = int(self.border[0][1])
@@ -55,9 +114,12 @@ class Patch():
         self._y_max = int(self.border[1][1])
         self.step=size[0] if step is None else step
         #self.mode='sparse' if mode is None else mode
-        self._patches =[]
+        self._patches =PatchTable(name=slide.name)
         self._labels = []
-        self._downsample=int(slide.level_downsamples[mag_level])
+        if mpp is not None:
+            self._downsample=mpp/slide.mpp
+        else:
+            self._downsample=int(slide.level_downsamples[mag_level])
         #num=self.generate_patches(self.step)
         #print(f'num patches: {num}')
         
@@ -100,7 +162,9 @@ class Patch():
 
     @patches.setter
     def patches(self,value):
-        self._patches=patches
+        if not isinstance(value,PatchTable):
+            value=PatchTable.from_records(value)
+        self._patches=value
 
 
     @property
@@ -108,10 +172,20 @@ class Patch():
         return self._labels
 
 
+    @property
+    def _mask_downsample(self):
+        """
+        level 0 pixels per mask pixel when patching between native
+        levels, None to use the native level
+        """
+        return None if self.mpp is None else self._downsample
+
+
     @property
     def config(self):
         config={'name':self.slide.name,
                 'mag':self.mag_level,
+                'mpp':self.mpp,
                 'size':self.size,
                 'step':self.step,
                 'border':self.border,
@@ -138,6 +212,18 @@ class Patch():
                 yield x, y
 
 
+    def _grid(self,step):
+        """
+        coordinate grid in the same order as _patching
+        :param step: level 0 step
+        :return xs, ys: ndarray x and y coordinates
+        """
+        xs=np.arange(self._x_min,self._x_max,step)
+        ys=np.arange(self._y_min,self._y_max,step)
+        xs,ys=np.meshgrid(xs,ys,indexing='ij')
+        return xs.ravel(), ys.ravel()
+
+
     def _remove_edge_case(self,x,y):
         """
         remove edge cases based on dimensions of patch
@@ -157,44 +243,132 @@ class Patch():
 
     def generate_patches(self, 
                          step, 
-                         edge_cases=False):
+                         edge_cases=False,
+                         tissue_threshold=None,
+                         mode='sparse',
+                         margin=0,
+                         focus_method='bbox',
+                         background=0.0,
+                         seed=None):
         """
         generate patch coordinates based on mag,step and size
         :param step: integer: step size
-        :param mode: sparse or focus
-        :param mask_flag: include masks
+        :param mode: sparse or focus. focus keeps only positions
+            within margin of an annotation plus a sample of background
+            positions
+        :param tissue_threshold: minimum tissue fraction of a patch
+            on the slide's low resolution tissue mask. Background
+            positions are dropped before any region is read
+        :param margin: level 0 distance from annotations kept in focus mode
+        :param focus_method: bbox to use polygon bounding boxes or mask
+            to use a distance dilated low resolution annotation mask
+        :param background: number of background positions sampled per
+            focus position
+        :param seed: random seed for background sampling
         :return len(self._patches): Number of patches
         """
         self.step=step
-        self._patches=[]
-        step=step*self._downsample
+        step=int(round(step*self._downsample))
 
         if (self._x_max,self._y_max)==self.slide.dims:
             edge_cases==True
-        for x, y in self._patching(step):
-            name=self.slide.name+'_'+str(x)+'_'+str(y)
-            if edge_cases:
-                if self._remove_edge_case(x,y):
-                    continue
-            self._patches.append({'name':name,'x':x,'y':y})
+        xs,ys=self._grid(step)
+        keep=np.ones(len(xs),dtype=bool)
+        if mode=='focus':
+            if focus_method=='bbox':
+                near=self._focus_bbox(step,margin)
+            elif focus_method=='mask':
+                near=self._focus_mask(xs,ys,margin)
+            else:
+                raise ValueError(f'unknown focus method {focus_method}')
+        if tissue_threshold is not None:
+            fractions=self.slide.tissue_mask.fractions(xs,ys,
+                                   self.size[0]*self._downsample,
+                                   self.size[1]*self._downsample)
+            keep&=fractions>=tissue_threshold
+        if edge_cases:
+            x_size=int(self.size[0]*self._downsample)
+            y_size=int(self.size[1]*self._downsample)
+            keep&=(xs+x_size<=self._x_max)&(ys+y_size<=self._y_max)
+        columns=None
+        if mode=='focus':
+            near&=keep
+            far=np.flatnonzero(keep&~near)
+            num=min(int(round(background*near.sum())),len(far))
+            rng=np.random.default_rng(seed)
+            keep=near.copy()
+            keep[rng.choice(far,num,replace=False)]=True
+            columns={'focus':near[keep]}
+        self._patches=PatchTable(xs[keep],ys[keep],self.slide.name,
+                                 columns=columns)
 
         self._number=len(self._patches)
         return self._number
 
 
+    def _focus_bbox(self, step, margin):
+        """
+        grid positions whose patch lies within margin of an
+        annotation bounding box. Each box marks a block of the grid
+        so no position is tested individually
+        :param step: level 0 step
+        :param margin: level 0 margin around boxes
+        :return near: ndarray bool in _grid order
+        """
+        nx=len(range(self._x_min,self._x_max,step))
+        ny=len(range(self._y_min,self._y_max,step))
+        near=np.zeros((nx,ny),dtype=bool)
+        if self.slide.annotations is None:
+            return near.ravel()
+        w=self.size[0]*self._downsample
+        h=self.size[1]*self._downsample
+        for x1, y1, x2, y2 in self.slide.annotations.bboxes.tolist():
+            i1=max(int(np.floor((x1-margin-w-self._x_min)/step))+1,0)
+            i2=min(int(np.ceil((x2+margin-self._x_min)/step)),nx)
+            j1=max(int(np.floor((y1-margin-h-self._y_min)/step))+1,0)
+            j2=min(int(np.ceil((y2+margin-self._y_min)/step)),ny)
+            near[i1:i2,j1:j2]=True
+        return near.ravel()
+
+
+    def _focus_mask(self, xs, ys, margin, level=6):
+        """
+        grid positions whose patch touches the annotation mask
+        dilated by margin. The mask is rasterized at a low resolution
+        level and dilated with a distance transform
+        :param xs: level 0 x coordinates
+        :param ys: level 0 y coordinates
+        :param margin: level 0 margin around annotations
+        :param level: pyramid level of the mask
+        :return near: ndarray bool
+        """
+        if self.slide.annotations is None:
+            return np.zeros(len(xs),dtype=bool)
+        level=min(level,self.slide.level_count-1)
+        downsample=self.slide.level_downsamples[level]
+        w,h=self.slide.level_dimensions[level]
+        mask=self.slide._rasterize(0,0,w,h,downsample)
+        distance=cv2.distanceTransform((mask==0).astype(np.uint8),cv2.DIST_L2,5)
+        #one extra mask pixel covers polygons lost to rounding
+        sat=cv2.integral((distance<=margin/downsample+1).astype(np.uint8))
+        x1=np.clip(np.floor(xs/downsample),0,w).astype(np.int64)
+        y1=np.clip(np.floor(ys/downsample),0,h).astype(np.int64)
+        x2=np.clip(np.ceil((xs+self.size[0]*self._downsample)/downsample),0,w).astype(np.int64)
+        y2=np.clip(np.ceil((ys+self.size[1]*self._downsample)/downsample),0,h).astype(np.int64)
+        return (sat[y2,x2]-sat[y1,x2]-sat[y2,x1]+sat[y1,x1])>0
+
+
     def focus(self, num=2):
         """
-        remove patches with no classes
+        remove patches with fewer than num classes, background
+        included
         :param num: number of classes required
         :return len(self._patches): number of patches
         """
-        for p in self._patches:
-            if self.slide.annotations is None:
-                x,y =(p['x'],p['y'])
-                mask=self.slide.slide_mask[y:y+self.size[0],x:x+self.size[1]]
-                classes = len(np.unique(mask))
-                if classes<num:
-                    self._patches.remove(p)
+        if self.slide.annotations is None or self.number==0:
+            return self.number
+        classes,counts=self._class_counts()
+        self._patches.filter((counts>0).sum(axis=1)>=num)
         return len(self._patches)
 
 
@@ -211,46 +385,95 @@ class Patch():
         return ratio>=threshold
     
 
+    def _class_counts(self, max_pixels=2**24):
+        """
+        per patch pixel count of each class. Masks are rasterized
+        once per horizontal band of the grid at the patching level
+        and counts read from one integral image per class
+        :param max_pixels: max band mask size
+        :return classes: ndarray class values
+        :return counts: ndarray (n,classes) pixel counts
+        """
+        idx=self._patches.index
+        xs=self._patches.x[idx].astype(np.int64)
+        ys=self._patches.y[idx].astype(np.int64)
+        if len(idx)==0:
+            return np.zeros(0,dtype=np.uint8), np.zeros((0,0),dtype=np.int64)
+        w,h=self.size[0],self.size[1]
+        downsample=self._mask_downsample
+        if downsample is None:
+            downsample=self.slide.level_downsamples[self.mag_level]
+        x0=int(xs.min())
+        px=np.round((xs-x0)/downsample).astype(np.int64)
+        py=np.round(ys/downsample).astype(np.int64)
+        width=int(px.max())+w
+        band=max(h,max_pixels//width)
+
+        order=np.argsort(py,kind='stable')
+        py_sorted=py[order]
+        bands=[]
+        start=0
+        while start<len(order):
+            end=max(int(np.searchsorted(py_sorted,py_sorted[start]+band-h,'right')),start+1)
+            rows=order[start:end]
+            top=int(py_sorted[start])
+            height=int(py_sorted[end-1])-top+h
+            mask=self.slide.generate_mask_region(x0,int(round(top*downsample)),
+                                                 width,height,self.mag_level,
+                                                 self._mask_downsample)
+            bands.append((rows,top,mask))
+            start=end
+
+        classes=np.unique(np.concatenate([np.unique(m) for _,_,m in bands]))
+        counts=np.zeros((len(idx),len(classes)),dtype=np.int64)
+        for rows, top, mask in bands:
+            bx=px[rows]
+            by=py[rows]-top
+            for j, c in enumerate(classes):
+                sat=cv2.integral((mask==c).astype(np.uint8))
+                counts[rows,j]=(sat[by+h,bx+w]-sat[by,bx+w]
+                                -sat[by+h,bx]+sat[by,bx])
+        return classes, counts
+
+
     #TODO: how to treat labels that don't pass
     #threshold test
     def generate_labels(self,
                         threshold=0.5,
-                        remove=True):
+                        remove=True,
+                        method='integral'):
         """
-        generate patch labels based on pixel-level annotations
+        generate patch labels based on pixel-level annotations.
+        Label is the majority non-background class if its share of
+        annotated pixels reaches threshold, background if the patch
+        has no annotated pixels
         :param threshold: threshold proportion
+        :param method: 'integral' labels the whole grid from per-class
+            integral images, 'masks' extracts every patch mask
         :return classes and count
         """
         #empty annotations
-        self._labels=[]
-        if self.slide.annotations is None: 
-            self._labels=[np.nan]*len(self._patches)
-
-        for i, (mask,_) in enumerate(self.extract_masks()):
-            cls,cnts=np.unique(mask, return_counts=True)
-            cls,cnts=(list(cls),list(cnts))
-            if cls!=[0]:
-                if 0 in cls:
-                    cnts.pop(cls.index(0))
-                    cls.remove(0)
-            y=cls[cnts.index(max(cnts))]
-            y_cnt=max(cnts)
-
-            if self._filter(y_cnt,cnts,threshold):
-                self._patches[i]['label']=y
-                self._labels.append(y)
-            else:
-                self._patches[i]['label']=np.nan
-                self._labels.append(np.nan)
-        
+        labels=np.full(self.number,np.nan)
+        if self.slide.annotations is not None and method=='integral':
+            labels=self._integral_labels(threshold)
+        elif self.slide.annotations is not None: 
+            for i, (mask,_) in enumerate(self.extract_masks()):
+                cls,cnts=np.unique(mask, return_counts=True)
+                cls,cnts=(list(cls),list(cnts))
+                if cls!=[0]:
+                    if 0 in cls:
+                        cnts.pop(cls.index(0))
+                        cls.remove(0)
+                y=cls[cnts.index(max(cnts))]
+                y_cnt=max(cnts)
+                if self._filter(y_cnt,cnts,threshold):
+                    labels[i]=y
+
+        self._patches.label[self._patches.index]=labels
         if remove:
-            num=0
-            for i, p in enumerate(self._patches):
-                if p['label'] is np.nan:
-                   del self._patches[i]
-                   del self._labels[i]
-                   num+=1
+            num=self._patches.filter(~np.isnan(labels))
             print(f'removed: {num}')
+        self._labels=list(self._patches.label[self._patches.index])
 
         cls,cnts=np.unique(self._labels,return_counts=True)
         print(pd.DataFrame({'classes':cls,'numbers':cnts}))
@@ -258,6 +481,159 @@ class Patch():
 
 
 
+    def _integral_labels(self, threshold):
+        """
+        labels of visible patches from banded class counts
+        :param threshold: threshold proportion
+        :return labels: ndarray float, nan when unlabelled
+        """
+        labels=np.full(self.number,np.nan)
+        classes,counts=self._class_counts()
+        fg=classes!=0
+        fg_classes=classes[fg].astype(np.float64)
+        fg_counts=counts[:,fg]
+        fg_total=fg_counts.sum(axis=1)
+        if fg_counts.shape[1]>0:
+            y=fg_classes[np.argmax(fg_counts,axis=1)]
+            ratio=fg_counts.max(axis=1)/np.maximum(fg_total,1)
+            labels=np.where(ratio>=threshold,y,np.nan)
+        if threshold<=1:
+            labels[fg_total==0]=0
+        return labels
+
+
+    @staticmethod
+    def _priority(seed, name, xs, ys):
+        """
+        uniform [0,1) priority per patch hashed from seed, slide
+        name and coordinates with the splitmix64 finalizer, so it
+        does not depend on grid order or chunking
+        :param seed: int seed
+        :param name: slide name
+        :param xs: level 0 x coordinates
+        :param ys: level 0 y coordinates
+        :return priority: ndarray float
+        """
+        with np.errstate(over='ignore'):
+            z=np.uint64(seed)*np.uint64(0x9E3779B97F4A7C15)
+            z=z+np.uint64(zlib.crc32(name.encode('utf-8')))
+            z=z^(np.asarray(xs).astype(np.uint64)<<np.uint64(32))
+            z=z^np.asarray(ys).astype(np.uint64)
+            z=(z^(z>>np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+            z=(z^(z>>np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+            z=z^(z>>np.uint64(31))
+        return (z>>np.uint64(11)).astype(np.float64)*2.0**-53
+
+
+    @staticmethod
+    def _bottom_k(priority, labels, n, stratify):
+        """
+        positions of the n lowest priorities, per label when
+        stratify. Unlabelled (nan) patches are never kept when
+        stratifying
+        :param n: int or dict {label:n}
+        :return idx: ndarray sorted positions
+        """
+        if not stratify:
+            return np.sort(np.argsort(priority,kind='stable')[:n])
+        idx=[]
+        for l in np.unique(labels[~np.isnan(labels)]):
+            quota=n.get(l,0) if isinstance(n,dict) else n
+            rows=np.flatnonzero(labels==l)
+            idx.append(rows[np.argsort(priority[rows],kind='stable')[:quota]])
+        return np.sort(np.concatenate(idx)) if idx else np.zeros(0,dtype=np.int64)
+
+
+    def _candidates(self, step, chunk, tissue_threshold=None):
+        """
+        stream grid positions in blocks of columns, in _grid order
+        :param step: level 0 step
+        :param chunk: approximate positions per block
+        :param tissue_threshold: minimum tissue fraction
+        :yield xs, ys: ndarray block coordinates
+        """
+        xs=np.arange(self._x_min,self._x_max,step)
+        ys=np.arange(self._y_min,self._y_max,step)
+        cols=max(1,chunk//max(len(ys),1))
+        for i in range(0,len(xs),cols):
+            bx,by=np.meshgrid(xs[i:i+cols],ys,indexing='ij')
+            bx,by=bx.ravel(),by.ravel()
+            if tissue_threshold is not None:
+                keep=self.slide.tissue_mask.fractions(bx,by,
+                                   self.size[0]*self._downsample,
+                                   self.size[1]*self._downsample)>=tissue_threshold
+                bx,by=bx[keep],by[keep]
+            yield bx, by
+
+
+    def sample(self, 
+               n, 
+               seed=0, 
+               stratify=False, 
+               step=None,
+               chunk=2**16,
+               threshold=0.5,
+               tissue_threshold=None):
+        """
+        deterministic sample of n patches, or n per label with
+        stratify. Every patch gets a priority hashed from seed, slide
+        name and coordinates and the n lowest are kept, a bottom-k
+        reservoir merged chunk by chunk. The same seed regenerates
+        the same subset whatever the chunking. With step the grid is
+        streamed and labelled chunk by chunk instead of sampling
+        generated patches, so only the sample is ever stored
+        :param n: sample size, per label when stratify, or dict {label:n}
+        :param seed: int seed
+        :param stratify: sample per label. Uses current labels, or
+            labels computed per chunk with threshold when streaming
+        :param step: stream the grid with this step
+        :param chunk: candidates per chunk
+        :param threshold: label threshold proportion when streaming
+        :param tissue_threshold: minimum tissue fraction when streaming
+        :return len(self._patches): number of patches
+        """
+        name=self.slide.name
+        if isinstance(n,dict) and not stratify:
+            raise ValueError('n per label requires stratify=True')
+        if step is None:
+            idx=self._patches.index
+            labels=self._patches.label[idx]
+            if stratify and len(labels) and np.isnan(labels).all():
+                raise ValueError('no patch labels to stratify by, run generate_labels first')
+            priority=self._priority(seed,name,self._patches.x[idx],
+                                    self._patches.y[idx])
+            keep=np.zeros(len(idx),dtype=bool)
+            keep[self._bottom_k(priority,labels,n,stratify)]=True
+            self._patches.filter(keep)
+            self._labels=list(self._patches.label[self._patches.index])
+            return len(self._patches)
+
+        if stratify and self.slide.annotations is None:
+            raise ValueError('no annotations to stratify by')
+        self.step=step
+        step=int(round(step*self._downsample))
+        kept=(np.zeros(0),np.zeros(0,dtype=np.int64),
+              np.zeros(0,dtype=np.int64),np.zeros(0))
+        patches=self._patches
+        try:
+            for xs, ys in self._candidates(step,chunk,tissue_threshold):
+                labels=np.full(len(xs),np.nan)
+                if stratify and self.slide.annotations is not None:
+                    self._patches=PatchTable(xs,ys,name)
+                    labels=self._integral_labels(threshold)
+                priority=self._priority(seed,name,xs,ys)
+                merged=[np.concatenate(a) for a in zip(kept,(priority,xs,ys,labels))]
+                kept=[a[self._bottom_k(merged[0],merged[3],n,stratify)] for a in merged]
+        finally:
+            self._patches=patches
+        order=np.lexsort((kept[2],kept[1]))
+        self._patches=PatchTable(kept[1][order],kept[2][order],name,
+                                 kept[3][order])
+        self._labels=list(self._patches.label)
+        self._number=len(self._patches)
+        return self._number
+
+
     def plot_class_dist(self):
         """
         plot label distribution
@@ -270,38 +646,111 @@ class Patch():
         return sns.barplot(x=cls,y=cnts)
 
 
+    def thumbnail_stats(self, level=6, saturation=20):
+        """
+        per patch colour statistics from a low resolution level.
+        Each patch footprint is averaged from integral images of
+        the level array so no patch is read. Like patch reads,
+        transparent and out of slide pixels count as black
+        :param level: pyramid level to sample
+        :param saturation: HSV saturation (0-255) below which a pixel
+            counts as background
+        :return stats: dict of ndarrays aligned with visible patches:
+            intensity, red, green, blue, saturation and background
+            (fraction of low saturation pixels)
+        """
+        level=min(level,self.slide.level_count-1)
+        image=self.slide.read_level_array(level,background=False)
+        downsample=self.slide.level_downsamples[level]
+        hsv_s=cv2.cvtColor(image,cv2.COLOR_RGB2HSV)[:,:,1]
+        h,w=hsv_s.shape
+        planes=[image[:,:,0],image[:,:,1],image[:,:,2],hsv_s,
+                (hsv_s<saturation).astype(np.uint8)]
+        sdepth=cv2.CV_32S if 255*(h+1)*(w+1)<2**31 else cv2.CV_64F
+
+        idx=self._patches.index
+        xs=self._patches.x[idx]/downsample
+        ys=self._patches.y[idx]/downsample
+        x1=np.round(xs).astype(np.int64)
+        y1=np.round(ys).astype(np.int64)
+        x2=np.maximum(np.round(xs+self.size[0]*self._downsample/downsample),x1+1).astype(np.int64)
+        y2=np.maximum(np.round(ys+self.size[1]*self._downsample/downsample),y1+1).astype(np.int64)
+        area=(x2-x1)*(y2-y1)
+        cx1,cx2=np.clip(x1,0,w),np.clip(x2,0,w)
+        cy1,cy2=np.clip(y1,0,h),np.clip(y2,0,h)
+        means=np.empty((len(idx),len(planes)))
+        for i, plane in enumerate(planes):
+            sat=cv2.integral(plane,sdepth=sdepth)
+            sums=sat[cy2,cx2]-sat[cy1,cx2]-sat[cy2,cx1]+sat[cy1,cx1]
+            means[:,i]=sums/area
+        #out of slide pixels are black, so unsaturated background
+        outside=area-(cx2-cx1)*(cy2-cy1)
+        means[:,4]+=outside/area
+        return {'intensity':means[:,:3].mean(axis=1),
+                'red':means[:,0],
+                'green':means[:,1],
+                'blue':means[:,2],
+                'saturation':means[:,3],
+                'background':means[:,4]}
+
+
     def filter_patches(self,
                        filter_type,
                        threshold,
-                       channel=None):
+                       channel=None,
+                       level=None,
+                       method='rank'):
         """
         filter patches based on pixel intensity
+        :param filter_type: entropy, intensity or background.
+            background drops patches whose fraction of low saturation
+            pixels is above threshold
         :param threshold: intesnity threshold value
         :param channel: channel index
+        :param level: pyramid level to compute intensity and background
+            from via thumbnail_stats instead of reading each patch.
+            background defaults to level 6
+        :param method: entropy method, rank (image_entropy), histogram
+            or box. See analysis.filters.entropy_agreement to match
+            thresholds between methods
         :return removed: number of removed
         """
         num_b4=self.number
-        patches=self._patches.copy()
-
-        if filter_type=='entropy':
+        keep=np.ones(num_b4,dtype=bool)
+
+        if filter_type=='entropy' and method!='rank':
+            batch,entropies=[],[np.zeros(0)]
+            for patch, p in self.extract_patches():
+                batch.append(np.array(patch))
+                if len(batch)==64:
+                    entropies.append(batch_entropy(batch,method))
+                    batch=[]
+            if batch:
+                entropies.append(batch_entropy(batch,method))
+            keep=np.concatenate(entropies)>=threshold
+
+        elif filter_type=='entropy':
             for i, (patch, p) in enumerate(self.extract_patches()):
-                avg_entropy=image_entropy(patch)
-                if avg_entropy<threshold:
-                    print('greg')
-                    patches.remove(p)
+                keep[i]=image_entropy(patch)>=threshold
+
+        elif filter_type=='intensity' and level is not None:
+            stats=self.thumbnail_stats(level)
+            key='intensity' if channel is None else ('red','green','blue')[channel]
+            keep=stats[key]<=threshold
 
         elif filter_type=='intensity':
             if channel is not None:
-                for patch,p in self.extract_patches():
-                    if np.mean(patch[:,:,channel])>threshold:
-                        self._patches.remove(p)
+                for i, (patch,p) in enumerate(self.extract_patches()):
+                    keep[i]=np.mean(patch[:,:,channel])<=threshold
             elif channel is None:
-                for patch,p in self.extract_patches():
-                    if np.mean(patch)>threshold:
-                        patches.remove(p)
-                        continue
+                for i, (patch,p) in enumerate(self.extract_patches()):
+                    keep[i]=np.mean(patch)<=threshold
+
+        elif filter_type=='background':
+            stats=self.thumbnail_stats(6 if level is None else level)
+            keep=stats['background']<=threshold
 
-        self._patches=patches.copy()
+        self._patches.filter(keep)
         removed=num_b4-len(self._patches)
         print('Num removed: {}'.format(removed))
         print('Remaining:{}'.format(len(self._patches)))
@@ -310,6 +759,47 @@ class Patch():
 
 
 
+    def qc(self, metrics=None, workers=None, threads=None, **kwargs):
+        """
+        compute QC metrics for every patch in one pass over the
+        slide and store them as patch table columns, so thresholds
+        can be applied later with qc_filter without reading again
+        :param metrics: names from QC_METRICS, defaults to all
+        :param workers: number of worker processes reading patches
+        :param threads: number of reader threads
+        :param kwargs: patch_metrics arguments
+        :return df: pd.DataFrame of visible patches with metrics
+        """
+        metrics=QC_METRICS if metrics is None else metrics
+        values=np.full((self.number,len(metrics)),np.nan)
+        patches=self.extract_patches(workers=workers,threads=threads)
+        for i, (patch, p) in enumerate(patches):
+            values[i]=list(patch_metrics(patch,metrics,**kwargs).values())
+        for j, m in enumerate(metrics):
+            self._patches.set_column(m,values[:,j])
+        return self._patches.df()
+
+
+    def qc_filter(self, **thresholds):
+        """
+        remove patches outside QC metric bounds, e.g.
+        qc_filter(background=(None,0.5),blur=(50,None))
+        :param thresholds: metric=(min,max), None for an open bound
+        :return removed: number of removed
+        """
+        idx=self._patches.index
+        keep=np.ones(len(idx),dtype=bool)
+        for m, (low, high) in thresholds.items():
+            if m not in self._patches.columns:
+                raise ValueError(f'{m} not computed, run qc first')
+            column=self._patches.columns[m][idx]
+            if low is not None:
+                keep&=column>=low
+            if high is not None:
+                keep&=column<=high
+        return self._patches.filter(keep)
+
+
     def extract_patch(self, x=None, y=None):
         """
         extract individual patch from WSI
@@ -321,41 +811,269 @@ class Patch():
         #points in read_region (x-x_size,y-y_size)
         #x_size=int(self.size[0]*self.mag_factor*.5)
         #y_size=int(self.size[1]*self.mag_factor*.5)
-        patch=self.slide.read_region((x,y), self.mag_level,
-                                     (self.size[0],self.size[1]))
-        patch=np.array(patch.convert('RGB'))
+        patch=self.slide.read_region_array((x,y),self.mag_level,
+                                           self._read_size,resize=self.size)
         return patch
 
 
-    def extract_patches(self):
+    def _chunks(self, workers, chunksize=None, max_bytes=2**27):
+        """
+        split visible patches into contiguous chunks of the grid
+        :param workers: number of worker processes
+        :param chunksize: patches per chunk, defaults to four
+            chunks per worker capped at max_bytes of pixels
+        :param max_bytes: max pixel bytes of a default chunk
+        :yield xs, ys: ndarray chunk coordinates
+        """
+        idx=self._patches.index
+        if chunksize is None:
+            patch_bytes=self.size[0]*self.size[1]*3
+            chunksize=min(int(np.ceil(len(idx)/(workers*4))),
+                          max_bytes//patch_bytes)
+            chunksize=max(1,chunksize)
+        xs=self._patches.x[idx]
+        ys=self._patches.y[idx]
+        for i in range(0,len(idx),chunksize):
+            yield xs[i:i+chunksize], ys[i:i+chunksize]
+
+
+    def _pool(self, workers):
+        """
+        process pool where each worker opens its own slide handle
+        :param workers: number of worker processes
+        :return pool: multiprocessing.Pool
+        """
+        pyramid=self.slide.mask_pyramid
+        pyramid_path=None if pyramid is None else os.path.dirname(pyramid.path)
+        initargs=(self.slide.path,self.slide.annotations,pyramid_path)
+        return mp.Pool(workers,_init_worker,initargs)
+
+
+    def _supertiles(self, max_pixels=2**25):
+        """
+        plan super-tile reads covering visible patches. Patches are
+        grouped into row bands at the patching level and each band
+        split along x so a super-tile stays under max_pixels. Every
+        pixel of an overlapping grid is covered by one read
+        :param max_pixels: max super-tile size at the patching level
+        :return tiles: list of (rows,x,y,w,h) with rows the visible
+            row positions in the tile, x,y the level 0 tile origin and
+            w,h the tile size at the native level read
         """
-        generator to extract all patches
+        idx=self._patches.index
+        if len(idx)==0:
+            return []
+        xs=self._patches.x[idx].astype(np.int64)
+        ys=self._patches.y[idx].astype(np.int64)
+        w,h=self._read_size
+        downsample=self.slide.level_downsamples[self.mag_level]
+        x0,y0=int(xs.min()),int(ys.min())
+        px=np.round((xs-x0)/downsample).astype(np.int64)
+        py=np.round((ys-y0)/downsample).astype(np.int64)
+        width=int(px.max())+w
+        band=max(h,max_pixels//width)
+
+        tiles=[]
+        order=np.argsort(py,kind='stable')
+        start=0
+        while start<len(order):
+            top=py[order[start]]
+            end=int(np.searchsorted(py[order],top+band-h,'right'))
+            band_rows=order[start:end]
+            height=int(py[band_rows].max()-top)+h
+            seg=max(w,max_pixels//height)
+            band_rows=band_rows[np.argsort(px[band_rows],kind='stable')]
+            i=0
+            while i<len(band_rows):
+                left=px[band_rows[i]]
+                j=int(np.searchsorted(px[band_rows],left+seg-w,'right'))
+                rows=band_rows[i:j]
+                tile_w=int(px[rows].max()-left)+w
+                tiles.append((rows,x0+int(round(left*downsample)),
+                              y0+int(round(top*downsample)),tile_w,height))
+                i=j
+            start=end
+        return tiles
+
+
+    def extract_patches(self, 
+                        workers=None, 
+                        chunksize=None, 
+                        supertile=None,
+                        threads=None,
+                        batch=16):
+        """
+        generator to extract all patches. With workers>1 patches
+        are read by a process pool in contiguous chunks and
+        yielded in order. With threads>1 patches are read by a
+        thread pool, one slide handle per thread, and yielded in
+        order. With supertile set, overlapping patches are sliced
+        as views out of large super-tile reads and yielded band by
+        band, in table order within each band but not overall, so
+        callers pairing patches with other data must match by name
+        :param workers: number of worker processes
+        :param chunksize: patches per worker task
+        :param supertile: max super-tile size in pixels at the
+            patching level
+        :param threads: number of reader threads
+        :param batch: patches read into one array at a time
         :yield patch: ndarray patch
         :yield p: patch dict metadata
         """
+        size=(self.size[0],self.size[1])
+        if supertile is not None:
+            idx=self._patches.index
+            w,h=self._read_size
+            downsample=self.slide.level_downsamples[self.mag_level]
+            tiles=self._supertiles(supertile)
+            band=[]
+            for k, (rows, x, y, tile_w, tile_h) in enumerate(tiles):
+                tile=self.slide.read_region_array((x,y),self.mag_level,
+                                                  (tile_w,tile_h))
+                for i in rows:
+                    tx=int(round((int(self._patches.x[idx[i]])-x)/downsample))
+                    ty=int(round((int(self._patches.y[idx[i]])-y)/downsample))
+                    band.append((i,tile[ty:ty+h,tx:tx+w]))
+                #tiles of a band share y, flush the band in table order
+                if k+1<len(tiles) and tiles[k+1][2]==y:
+                    continue
+                band.sort(key=lambda b: b[0])
+                for i, patch in band:
+                    if (w,h)!=size:
+                        patch=Slide._resample(patch,size)
+                    yield patch, self._patches._row(idx[i])
+                band=[]
+            return
+
+        if threads is not None and threads>1:
+            with SlidePool(self.slide) as pool:
+                def read(p):
+                    patch=pool.read_region_array((p['x'],p['y']),self.mag_level,
+                                                 self._read_size,resize=size)
+                    return patch, p
+                yield from pool.imap(read,self._patches,threads)
+            return
+
+        if workers is None or workers<=1:
+            idx=self._patches.index
+            for i in range(0,len(idx),batch):
+                rows=idx[i:i+batch]
+                locations=list(zip(self._patches.x[rows].tolist(),
+                                   self._patches.y[rows].tolist()))
+                patches=self.slide.read_regions_array(locations,self.mag_level,
+                                                      self._read_size,resize=size)
+                for patch, r in zip(patches,rows):
+                    yield patch, self._patches._row(r)
+            return
+
+        tasks=((xs,ys,self.mag_level,self._read_size,size) 
+               for xs,ys in self._chunks(workers,chunksize))
+        rows=iter(self._patches)
+        #at most two chunks per worker in flight, imap has no backpressure
+        pending=deque()
+        with self._pool(workers) as pool:
+            for task in tasks:
+                pending.append(pool.apply_async(_extract_chunk,(task,)))
+                if len(pending)<2*workers:
+                    continue
+                for patch in pending.popleft().get():
+                    yield patch, next(rows)
+            while pending:
+                for patch in pending.popleft().get():
+                    yield patch, next(rows)
+
+
+    def _context_levels(self, factors):
+        """
+        native level, read size and level 0 extent of each context
+        :param factors: context downsample relative to the patch
+        :return levels: list of (level,read_size,(w,h)) per factor
+        """
+        levels=[]
+        for f in factors:
+            downsample=self._downsample*f
+            level=self.slide.get_best_level_for_downsample(downsample)
+            scale=downsample/self.slide.level_downsamples[level]
+            read_size=(int(round(self.size[0]*scale)),int(round(self.size[1]*scale)))
+            levels.append((level,read_size,(self.size[0]*downsample,
+                                             self.size[1]*downsample)))
+        return levels
+
+
+    def extract_context(self, x=None, y=None, factors=(4,), reader=None):
+        """
+        patch and concentric context patches centred on the patch
+        centre, each read from the nearest native level at or above
+        its resolution and resized to the patch size
+        :param x: int x coordinate of patch
+        :param y: int y coordinate of patch
+        :param factors: context downsample relative to the patch, 4
+            gives a 2.5x context around a 10x patch
+        :param reader: Slide or SlidePool to read from
+        :return patches: list of ndarray, the patch first
+        """
+        reader=self.slide if reader is None else reader
+        cx=x+self.size[0]*self._downsample/2
+        cy=y+self.size[1]*self._downsample/2
+        patches=[reader.read_region_array((x,y),self.mag_level,
+                                          self._read_size,resize=self.size)]
+        for level, read_size, (w,h) in self._context_levels(factors):
+            location=(int(round(cx-w/2)),int(round(cy-h/2)))
+            patches.append(reader.read_region_array(location,level,read_size,
+                                                    resize=self.size))
+        return patches
+
+
+    def extract_contexts(self, factors=(4,), threads=None):
+        """
+        generator of aligned patch and context tuples for all
+        patches, in order
+        :param factors: context downsample relative to the patch
+        :param threads: number of reader threads
+        :yield patches: list of ndarray, the patch first
+        :yield p: patch dict metadata
+        """
+        if threads is not None and threads>1:
+            with SlidePool(self.slide) as pool:
+                def read(p):
+                    return self.extract_context(p['x'],p['y'],factors,pool), p
+                yield from pool.imap(read,self._patches,threads)
+            return
         for p in self._patches:
-            patch=self.extract_patch(p['x'],p['y'])
-            yield patch, p
+            yield self.extract_context(p['x'],p['y'],factors), p
 
 
     def extract_mask(self, x=None, y=None):
         """
-        extract binary mask corresponding to patch
-        from slide_mask
+        extract mask corresponding to patch, rasterized
+        directly at the patching level
         :param x: int x coordinate
         :param y: int y coordinate
+        :return mask: ndarray mask
         """
-        #if we want x,y coordinate of point to be central
-        #x_size=int(self.size[0]*self.mag_factor*.5)
-        #y_size=int(self.size[1]*self.mag_factor*.5)
-        #[y-y_size:y+y_size,x-x_size:x+x_size]
-        x_size=int(self.size[0]*self._downsample)
-        y_size=int(self.size[1]*self._downsample)
-        mask=self.slide.generate_mask()[y:y+y_size,x:x+x_size]
-        mask=cv2.resize(mask,(self.size[0],self.size[1]))
+        mask=self.slide.generate_mask_region(x,y,self.size[0],
+                                             self.size[1],
+                                             self.mag_level,
+                                             self._mask_downsample)
         return mask
 
 
+    def extract_feature_masks(self, x=None, y=None, features=None):
+        """
+        extract one binary mask per feature for the patch
+        :param x: int x coordinate
+        :param y: int y coordinate
+        :param features: annotation labels, defaults to all labels
+        :return masks: ndarray (n,h,w) masks
+        """
+        masks=self.slide.generate_feature_masks(x,y,self.size[0],
+                                                self.size[1],
+                                                self.mag_level,
+                                                self._mask_downsample,
+                                                features)
+        return masks
+
+
     def extract_masks(self):
         """
         extract all masks
@@ -387,11 +1105,46 @@ class Patch():
              filename=filename+'_'+str(x)+'_'+str(y)+'.png'
              image_path=os.path.join(path,filename)
 
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if image.ndim==3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         status=cv2.imwrite(image_path,image)
         return status
    
     
+    @staticmethod
+    def _mask_dirs(path, features=None):
+        """
+        create mask directories, path itself for the multi-label
+        mask or one subdirectory per feature
+        :param path: mask directory
+        :param features: annotation labels or None
+        :return dirs: list of directories
+        """
+        dirs=[path] if features is None else [os.path.join(path,f) for f in features]
+        for d in dirs:
+            os.makedirs(d,exist_ok=True)
+        return dirs
+
+
+    @staticmethod
+    def _save_masks(slide, x, y, size, level, mask_downsample, features,
+                    mask_dirs, filename):
+        """
+        rasterize and save the masks of one patch
+        :param slide: Slide to rasterize from
+        :param features: annotation labels or None for a multi-label mask
+        :param mask_dirs: directories from _mask_dirs
+        """
+        if features is None:
+            masks=[slide.generate_mask_region(x,y,size[0],size[1],level,
+                                              mask_downsample)]
+        else:
+            masks=slide.generate_feature_masks(x,y,size[0],size[1],level,
+                                               mask_downsample,features)
+        for mask, d in zip(masks,mask_dirs):
+            Patch._save_disk(mask,d,filename,x,y)
+
+
     def save_mask(self,path,dir_name):
 
         mask_generator=self.extract_masks()
@@ -406,55 +1159,104 @@ class Patch():
              path, 
              mask_flag=False, 
              label_dir=False, 
-             label_csv=False):
+             label_csv=False,
+             workers=None,
+             chunksize=None,
+             threads=None,
+             features=None,
+             context=None):
         """
-        object save method. saves down all patches
+        object save method. saves down all patches. Images are read
+        once and masks saved alongside them in the same pass
         :param path: save path
         :param masK_flag: boolean to save masks
         :param label_dir: label directory
         :param label_csv: boolean to save labels in csv
+        :param workers: number of worker processes. Workers read
+            and write their chunks directly (label_dir unsupported)
+        :param chunksize: patches per worker task
+        :param threads: number of reader threads
+        :param features: annotation labels to save as binary masks
+            in masks/<feature>. None saves one multi-label mask
+        :param context: context factors (see extract_context). Each
+            context is saved under the patch filename in context_<f>
+            in the same pass (workers unsupported)
         """
         patch_path=os.path.join(path,'images')
         os.makedirs(patch_path,exist_ok=True)
         filename=self.slide.name
-
-        for patch,p in self.extract_patches():
+        mask_dirs=[]
+        if mask_flag:
+            mask_dirs=self._mask_dirs(os.path.join(path,'masks'),features)
+        size=(self.size[0],self.size[1])
+        context_dirs=[]
+        for f in context or []:
+            context_dirs.append(os.path.join(path,f'context_{f}'))
+            os.makedirs(context_dirs[-1],exist_ok=True)
+
+        if workers is not None and workers>1 and context is None:
+            tasks=[(xs,ys,self.mag_level,self._read_size,size,
+                    self._mask_downsample,patch_path,mask_dirs,features,
+                    filename)
+                   for xs,ys in self._chunks(workers,chunksize)]
+            with self._pool(workers) as pool:
+                num=sum(pool.imap_unordered(_save_chunk,tasks))
+            if label_csv:
+                df=self._patches.df()
+                df.to_csv(os.path.join(path,'labels.csv'))
+            return num
+
+        if context is not None:
+            patches=((c[0],c[1:],p) for c,p in self.extract_contexts(context,threads))
+        else:
+            patches=((patch,[],p) for patch,p in self.extract_patches(threads=threads))
+        for patch,contexts,p in patches:
             if label_dir:
                  patch_path=os.path.join(patch_path,patch['labels'])
             self._save_disk(patch,patch_path,filename,p['x'],p['y'])
-        if mask_flag:
-            mask_generator=self.extract_masks()
-            mask_path=os.path.join(path,'masks')
-            os.makedirs(mask_path,exist_ok=True)
-            if label_dir:
-                patch_path=os.path.join(path_path,patch['labels'])
-            for mask,m in self.extract_masks():
-                self._save_disk(mask,mask_path,filename,m['x'],m['y'])
+            for c, d in zip(contexts,context_dirs):
+                self._save_disk(c,d,filename,p['x'],p['y'])
+            if mask_dirs:
+                self._save_masks(self.slide,p['x'],p['y'],size,
+                                 self.mag_level,self._mask_downsample,
+                                 features,mask_dirs,filename)
 
         if label_csv:
-            df=pd.DataFrame(self._patches,columns=['names','x','y','labels'])
+            df=self._patches.df()
             df.to_csv(os.path.join(path,'labels.csv'))
 
 
-    def to_lmdb(self, db_path, write_frequency=100):
+    def to_lmdb(self, 
+                db_path, 
+                write_frequency=100, 
+                workers=None, 
+                threads=None,
+                context=None):
+        #torch is only needed when writing lmdb
+        from pyslide.io.lmdb_io import LMDBWrite
         size_estimate=len(self._patches)*self.size[0]*self.size[1]*3
         db_write=LMDBWrite(db_path,size_estimate,write_frequency)
-        db_write.write(self)
+        db_write.write(self,workers,threads,context)
             
 
     def to_tfrecords(self, 
                      db_path,
                      shard_size=0.01,
-                     unit=1e9
+                     unit=1e9,
+                     workers=None,
+                     threads=None,
+                     context=None
                      ):
-        TFRecordWrite(db_path,self,shard_size,unit).convert()
+        #tensorflow is only needed when writing tfrecords
+        from pyslide.io.tfrecords_io import TFRecordWrite
+        TFRecordWrite(db_path,self,shard_size,unit,workers,threads,context).convert()
         
         
 
 
 class Stitching():
 
-    MAG_FACTORS={0:1,1:2,2:4,3:8,4:16,5:32,5:64}
+    MAG_FACTORS={0:1,1:2,2:4,3:8,4:16,5:32,6:64}
 
     def __init__(self,patch_path,
                  slide=None,
@@ -517,6 +1319,8 @@ class Stitching():
 
     @property
     def mag_factor(self):
+         if self.slide is not None:
+             return self.slide.level_downsamples[self.mag_level]
          return Stitching.MAG_FACTORS[self.mag_level]
     
     #TODO: check required coordinates according to parameters
@@ -0,0 +1,121 @@
+"""
+pool.py: contains SlidePool class
+
+SlidePool class - hands out one slide handle per thread for the same
+file so concurrent reads do not contend on a single OpenSlide handle.
+Slide methods called on the pool run on the calling thread's handle;
+metadata (dimensions, level_downsamples, name, annotations) is read
+from the slide the pool wraps and mask pyramid, tissue mask and region
+cache are shared between handles.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from openslide import OpenSlide
+
+from pyslide.slide import Slide
+
+__author__='Gregory Verghese'
+__email__='gregory.verghese@gmail.com'
+
+
+class SlidePool():
+    """
+    Per-thread slide handles over one slide file.
+
+    :param slide: pyslide.Slide the pool reads metadata and shared
+        state from
+    """
+    def __init__(self, slide):
+        self.slide=slide
+        self._local=threading.local()
+        self._handles=[]
+        self._lock=threading.Lock()
+        self._cache_read=None
+        if slide.region_cache is not None:
+            self._cache_read=slide.region_cache.read
+            slide.region_cache.read=self._read_uncached
+
+
+    def __getattr__(self, name):
+        if name=='slide':
+            raise AttributeError(name)
+        if callable(getattr(type(self.slide),name,None)):
+            return getattr(self.handle,name)
+        return getattr(self.slide,name)
+
+
+    def __repr__(self):
+        return f'SlidePool(slide: {self.slide.name}, handles: {len(self._handles)})'
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    @property
+    def handle(self):
+        """
+        slide handle owned by the calling thread, opened on first use
+        :return handle: pyslide.Slide
+        """
+        handle=getattr(self._local,'handle',None)
+        if handle is None:
+            handle=Slide(self.slide.path,
+                         mag=self.slide.mag,
+                         annotations=self.slide.annotations,
+                         meta_dir=self.slide.meta_dir)
+            handle.mpp=self.slide.mpp
+            handle.mask_pyramid=self.slide.mask_pyramid
+            handle._tissue_mask=self.slide._tissue_mask
+            handle._border=self.slide._border
+            handle.region_cache=self.slide.region_cache
+            self._local.handle=handle
+            with self._lock:
+                self._handles.append(handle)
+        return handle
+
+
+    def _read_uncached(self, location, level, size):
+        return OpenSlide.read_region(self.handle,location,level,size)
+
+
+    def imap(self, fn, iterable, threads=4, prefetch=None):
+        """
+        apply fn to items on a thread pool, yielding results in order
+        with at most prefetch items in flight
+        :param fn: function of one item, may call pool read methods
+        :param iterable: items
+        :param threads: number of threads
+        :param prefetch: max items in flight, defaults to 2*threads
+        :yield result: fn(item)
+        """
+        prefetch=2*threads if prefetch is None else prefetch
+        futures=deque()
+        with ThreadPoolExecutor(threads) as executor:
+            for item in iterable:
+                futures.append(executor.submit(fn,item))
+                if len(futures)>=prefetch:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+
+    def close(self):
+        """
+        close thread handles and restore the region cache reader
+        """
+        if self._cache_read is not None:
+            self.slide.region_cache.read=self._cache_read
+            self._cache_read=None
+        with self._lock:
+            for handle in self._handles:
+                handle.close()
+            self._handles=[]
+        self._local=threading.local()
@@ -12,10 +12,15 @@ Annotation class: Parses annotation file output from:
 """
 
 import os
+import sys
 import glob
 import json
+import shutil
+import hashlib
+import tempfile
 import itertools
 import xml.etree.ElementTree as ET
+from ctypes import POINTER, c_uint32
 
 import numpy as np
 import openslide
@@ -23,11 +28,17 @@ import cv2
 import seaborn as sns
 from matplotlib.path import Path
 from openslide import OpenSlide
+from openslide import lowlevel
 import pandas as pd
 import seaborn as sns
 from itertools import chain
 import operator as op
+from PIL import Image
 from pyslide.util.utilities import mask2rgb
+from pyslide.util.spatial import GridIndex
+from pyslide.util.fileio import share_mode
+from pyslide.mask import MaskPyramid, TissueMask
+from pyslide.cache import RegionCache, SlideMeta
 
 
 __author__='Gregory Verghese'
@@ -44,6 +55,13 @@ class Slide(OpenSlide):
     :param name: string name
     :param draw_border: boolean to generate border based on annotations
     :param _border: list of border coordinates [(x1,y1),(x2,y2)]
+    :param mask_pyramid: MaskPyramid serving annotation masks
+    :param region_cache: RegionCache serving read_region, None
+        unless enabled
+    :param mpp: level 0 microns per pixel, read from slide
+        properties unless set
+    :param meta: SlideMeta sidecar serving level images and
+        thumbnails
     """
     MAG_FACTORS={0:1,1:2,2:4,3:8,4:16,5:32,6:64}
     MASK_SIZE=(2000,2000)
@@ -54,13 +72,21 @@ class Slide(OpenSlide):
                  annotations=None,
                  annotations_path=None,
                  labels=None,
-                 source=None):
+                 source=None,
+                 meta_dir=None):
         super().__init__(filename)
 
         self.mag=mag
         self.dims=self.dimensions
+        self.path=filename
         self.name=os.path.basename(filename)[:-5]
         self._border=None
+        self._tissue_mask=None
+        self.mask_pyramid=None
+        self.region_cache=None
+        self._mpp=None
+        self.meta_dir=meta_dir
+        self.meta=SlideMeta(filename,meta_dir,slide=self)
 
         if annotations is not None:
             self.annotations=annotations
@@ -75,12 +101,354 @@ class Slide(OpenSlide):
 
     @property
     def slide_mask(self):
-       mask=self.generate_mask((Slide.MASK_SIZE))
+       mask=self.mask_thumbnail(Slide.MASK_SIZE)
        mask=mask2rgb(mask)
 
        return mask
 
 
+    def mask_thumbnail(self, size):
+        """
+        class mask of the whole slide rasterized directly at size
+        :param size: (w,h) output size
+        :return mask: ndarray (h,w) uint8
+        """
+        w,h=int(size[0]),int(size[1])
+        downsample=(self.dims[0]/w,self.dims[1]/h)
+        return self._rasterize(0,0,w,h,downsample)
+
+
+    def overlay(self, size=(2000,2000), prediction=None, alpha=0.5, thickness=2):
+        """
+        QC image of slide thumbnail with annotations blended in and
+        prediction outlines drawn on top. Annotations are rasterized
+        at the thumbnail size
+        :param size: (w,h) maximum output size
+        :param prediction: ndarray class mask of any size covering
+            the slide
+        :param alpha: annotation opacity
+        :param thickness: prediction outline thickness
+        :return image: ndarray (h,w,3) uint8 RGB
+        """
+        image=self.meta.thumbnail(size).copy()
+        h,w=image.shape[:2]
+        n_classes=None
+        if self.annotations is not None:
+            n_classes=len(self.annotations.class_key)+1
+        mask=self.mask_thumbnail((w,h))
+        annotated=mask>0
+        if annotated.any():
+            colors=mask2rgb(mask,n_classes)
+            blend=cv2.addWeighted(image,1-alpha,colors,alpha,0)
+            image[annotated]=blend[annotated]
+        if prediction is not None:
+            prediction=cv2.resize(np.asarray(prediction,dtype=np.uint8),(w,h),
+                                  interpolation=cv2.INTER_NEAREST)
+            n_classes=max(n_classes or 0,int(prediction.max())+1)
+            lut=mask2rgb(np.arange(n_classes,dtype=np.uint8)[None],n_classes)[0]
+            for c in np.unique(prediction[prediction>0]):
+                contours,_=cv2.findContours((prediction==c).astype(np.uint8),
+                                            cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
+                cv2.drawContours(image,contours,-1,lut[c].tolist(),thickness)
+        return image
+
+
+    @property
+    def mpp(self):
+        if self._mpp is None and openslide.PROPERTY_NAME_MPP_X in self.properties:
+            self._mpp=float(self.properties[openslide.PROPERTY_NAME_MPP_X])
+        return self._mpp
+
+
+    @mpp.setter
+    def mpp(self, value):
+        self._mpp=value
+
+
+    def level_for_mpp(self, mpp):
+        """
+        closest native level at or above the target resolution and
+        the residual downsample left to resample after reading it
+        :param mpp: target microns per pixel
+        :return level: pyramid level to read
+        :return residual: downsample from level to target, below 1
+            only when the target is finer than level 0
+        """
+        if self.mpp is None:
+            raise ValueError(f'{self.name}: microns per pixel unknown, set slide.mpp')
+        downsample=mpp/self.mpp
+        level=self.get_best_level_for_downsample(downsample)
+        residual=downsample/self.level_downsamples[level]
+        return level, residual
+
+
+    @property
+    def tissue_mask(self):
+        if self._tissue_mask is None:
+            self._tissue_mask=TissueMask(self,cache_dir=self.meta_dir)
+        return self._tissue_mask
+
+
+    def build_mask_pyramid(self, path=None, band=4096):
+        """
+        Serve annotation masks from a memory-mapped pyramid matching
+        level_downsamples. Levels are rasterized on first use and
+        reused across processes
+        :param path: directory for mask files
+        :param band: rows rasterized at a time
+        :return self.mask_pyramid: MaskPyramid
+        """
+        self.mask_pyramid=MaskPyramid(self,path,band)
+        return self.mask_pyramid
+
+
+    def enable_region_cache(self, max_bytes=2**30, block=1024):
+        """
+        Serve read_region from a byte bounded LRU cache of decoded
+        blocks aligned to each level's pixel grid
+        :param max_bytes: cache size limit in bytes
+        :param block: block side in level pixels
+        :return self.region_cache: RegionCache
+        """
+        self.region_cache=RegionCache(super().read_region,max_bytes,block)
+        return self.region_cache
+
+
+    @property
+    def cache_info(self):
+        if self.region_cache is None:
+            return None
+        return self.region_cache.info
+
+
+    def _use_cache(self, location, level, size):
+        downsample=self.level_downsamples[level]
+        return (self.region_cache is not None and location[0]%downsample==0
+                and location[1]%downsample==0 and size[0]>0 and size[1]>0)
+
+
+    def read_region(self, location, level, size):
+        """
+        openslide read_region served from the region cache when
+        enabled. Locations off the level grid bypass the cache
+        :param location: (x,y) level 0 coordinates
+        :param level: pyramid level
+        :param size: (w,h) region size at level
+        :return image: PIL RGBA image
+        """
+        if not self._use_cache(location,level,size):
+            return super().read_region(location,level,size)
+        downsample=self.level_downsamples[level]
+        x,y=location
+        region=self.region_cache.region(int(x//downsample),int(y//downsample),
+                                        int(size[0]),int(size[1]),level,downsample)
+        return Image.fromarray(region,'RGBA')
+
+
+    def _read_argb(self, location, level, size, buf=None):
+        """
+        premultiplied ARGB pixels straight from openslide
+        :param location: (x,y) level 0 coordinates
+        :param level: pyramid level
+        :param size: (w,h) region size at level
+        :param buf: optional (h,w) uint32 buffer to read into
+        :return buf: ndarray (h,w) uint32
+        """
+        w,h=int(size[0]),int(size[1])
+        if buf is None:
+            buf=np.empty((h,w),dtype=np.uint32)
+        #private API, tested with openslide-python 1.4.6
+        try:
+            lowlevel._read_region(self._osr,buf.ctypes.data_as(POINTER(c_uint32)),
+                                  int(location[0]),int(location[1]),level,w,h)
+        except (AttributeError, TypeError):
+            region=np.asarray(OpenSlide.read_region(self,location,level,(w,h)))
+            rgba=region.astype(np.uint32)
+            alpha=rgba[...,3]
+            buf[:]=alpha<<24
+            for i, shift in enumerate((16,8,0)):
+                buf|=(rgba[...,i]*alpha//255)<<shift
+        return buf
+
+
+    @staticmethod
+    def _composite(out, partial, rgb, alpha, background=None):
+        """
+        write pixels that are not fully opaque. Transparent pixels
+        are black unless composited onto background
+        :param out: ndarray (h,w,3) uint8 RGB
+        :param partial: ndarray (h,w) bool pixels to write
+        :param rgb: ndarray (n,3) un-premultiplied colours
+        :param alpha: ndarray (n,1) alpha
+        :param background: (r,g,b) background colour
+        """
+        if background is not None:
+            bg=np.asarray(background,dtype=np.uint32)
+            rgb=(rgb*alpha+bg*(255-alpha)+127)//255
+        out[partial]=rgb
+
+
+    @staticmethod
+    def _argb2rgb(buf, out, background=None):
+        """
+        convert premultiplied ARGB to RGB in place in out
+        :param buf: ndarray (h,w) uint32 ARGB
+        :param out: ndarray (h,w,3) uint8 RGB
+        :param background: (r,g,b) background colour
+        :return out: ndarray (h,w,3) uint8
+        """
+        if sys.byteorder=='little' and out.flags.c_contiguous:
+            bgra=buf.view(np.uint8).reshape(buf.shape+(4,))
+            cv2.cvtColor(bgra,cv2.COLOR_BGRA2RGB,dst=out)
+        else:
+            out[...,0]=(buf>>16)&255
+            out[...,1]=(buf>>8)&255
+            out[...,2]=buf&255
+        partial=buf<0xff000000
+        if partial.any():
+            argb=buf[partial].astype(np.uint64)
+            a=(argb>>24)[:,None]
+            c=np.stack([(argb>>16)&255,(argb>>8)&255,argb&255],axis=1)
+            rgb=np.where(a>0,c*255//np.maximum(a,1),0)
+            Slide._composite(out,partial,rgb,a,background)
+        return out
+
+
+    def read_region_array(self, 
+                          location, 
+                          level, 
+                          size, 
+                          out=None, 
+                          background=None,
+                          resize=None):
+        """
+        read region straight into an RGB uint8 array, skipping the
+        PIL RGBA image and RGB conversion
+        :param location: (x,y) level 0 coordinates
+        :param level: pyramid level
+        :param size: (w,h) region size at level
+        :param out: optional (h,w,3) uint8 buffer to write into
+        :param background: (r,g,b) colour transparent pixels are
+            composited onto, black if None
+        :param resize: (w,h) to resample the region to
+        :return out: ndarray (h,w,3) uint8
+        """
+        w,h=int(size[0]),int(size[1])
+        if resize is not None and (int(resize[0]),int(resize[1]))!=(w,h):
+            region=self.read_region_array(location,level,size,background=background)
+            region=Slide._resample(region,resize)
+            if out is None:
+                return region
+            np.copyto(out,region)
+            return out
+        if out is None:
+            out=np.empty((h,w,3),dtype=np.uint8)
+        if w==0 or h==0:
+            return out
+        if self._use_cache(location,level,size):
+            downsample=self.level_downsamples[level]
+            x,y=location
+            region=self.region_cache.region(int(x//downsample),int(y//downsample),
+                                            w,h,level,downsample)
+            if out.flags.c_contiguous:
+                cv2.cvtColor(region,cv2.COLOR_RGBA2RGB,dst=out)
+            else:
+                np.copyto(out,region[...,:3])
+            if background is not None:
+                partial=region[...,3]!=255
+                if partial.any():
+                    a=region[...,3][partial].astype(np.uint32)[:,None]
+                    rgb=region[...,:3][partial].astype(np.uint32)
+                    self._composite(out,partial,rgb,a,background)
+            return out
+        return self._argb2rgb(self._read_argb(location,level,size),out,background)
+
+
+    def read_regions_array(self, 
+                           locations, 
+                           level, 
+                           size, 
+                           out=None, 
+                           background=None,
+                           resize=None):
+        """
+        read many equally sized regions into one (n,h,w,3) array
+        :param locations: list of (x,y) level 0 coordinates
+        :param level: pyramid level
+        :param size: (w,h) region size at level
+        :param out: optional (n,h,w,3) uint8 buffer to write into
+        :param background: (r,g,b) colour for transparent pixels
+        :param resize: (w,h) to resample each region to
+        :return out: ndarray (n,h,w,3) uint8
+        """
+        w,h=int(size[0]),int(size[1])
+        if resize is not None and (int(resize[0]),int(resize[1]))==(w,h):
+            resize=None
+        out_w,out_h=(w,h) if resize is None else (int(resize[0]),int(resize[1]))
+        if out is None:
+            out=np.empty((len(locations),out_h,out_w,3),dtype=np.uint8)
+        buf=np.empty((h,w),dtype=np.uint32)
+        for i, location in enumerate(locations):
+            if (self._use_cache(location,level,size) or w==0 or h==0 
+                or resize is not None):
+                self.read_region_array(location,level,size,out[i],background,resize)
+            else:
+                self._argb2rgb(self._read_argb(location,level,size,buf),
+                               out[i],background)
+        return out
+
+
+    @staticmethod
+    def _resample(image, size):
+        """
+        resize with area averaging when shrinking, linear otherwise
+        :param image: ndarray image
+        :param size: (w,h) output size
+        :return image: ndarray resized image
+        """
+        size=(int(size[0]),int(size[1]))
+        shrink=size[0]<image.shape[1] or size[1]<image.shape[0]
+        interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LINEAR
+        return cv2.resize(image,size,interpolation=interpolation)
+
+
+    def read_region_mpp(self, location, mpp, size, out=None):
+        """
+        read region at a target resolution. Reads the closest native
+        level at or above it and resamples only the residual factor
+        :param location: (x,y) level 0 coordinates
+        :param mpp: target microns per pixel
+        :param size: (w,h) region size at target resolution
+        :param out: optional (h,w,3) uint8 buffer to write into
+        :return out: ndarray (h,w,3) uint8
+        """
+        level,residual=self.level_for_mpp(mpp)
+        read_size=(int(round(size[0]*residual)),int(round(size[1]*residual)))
+        return self.read_region_array(location,level,read_size,out,resize=size)
+
+
+    def read_level_array(self, level, background=True):
+        """
+        whole pyramid level as RGB on the slide background colour,
+        as get_thumbnail returns for the level's own dimensions.
+        Served from the metadata sidecar after the first read
+        :param level: pyramid level
+        :param background: False composites transparent pixels on
+            black, as read_region_array does for patches
+        :return image: ndarray (h,w,3) uint8
+        """
+        return self.meta.level_array(level,background)
+
+
+    def _read_level_array(self, level, background=True):
+        color=None
+        if background:
+            color=self.properties.get(openslide.PROPERTY_NAME_BACKGROUND_COLOR,'ffffff')
+            color=tuple(int(color[i:i+2],16) for i in (0,2,4))
+        return self.read_region_array((0,0),level,self.level_dimensions[level],
+                                      background=color)
+
+
     def generate_mask(self, size=None):
         """
         Generates mask representation of annotations.
@@ -103,6 +471,95 @@ class Slide(OpenSlide):
         return slide_mask
 
 
+    def generate_mask_region(self, x, y, w, h, level=0, downsample=None):
+        """
+        Generates mask representation of annotations inside a
+        window of the slide. Only polygons intersecting the window
+        are drawn, after being shifted and scaled into window
+        coordinates, so cost scales with the window not the slide.
+        OpenCV clips polygons crossing the window border, so edge
+        pixels there can differ by one from generate_mask.
+
+        :param x: int level 0 x coordinate of window
+        :param y: int level 0 y coordinate of window
+        :param w: int window width in pixels at level
+        :param h: int window height in pixels at level
+        :param level: pyramid level of returned mask
+        :param downsample: level 0 pixels per mask pixel, overrides
+            level for resolutions between native levels
+        :return mask: ndarray (h,w) single channel mask with
+            integer for each class
+        """
+        if downsample is None:
+            downsample=self.level_downsamples[level]
+        if (self.mask_pyramid is not None 
+            and downsample==self.level_downsamples[level]):
+            return self.mask_pyramid.region(x,y,w,h,level)
+        return self._rasterize(x,y,w,h,downsample)
+
+
+    def _rasterize(self, x, y, w, h, downsample):
+        """
+        Fill annotation polygons into a (h,w) buffer whose origin
+        is level 0 point (x,y) and whose pixels cover downsample
+        level 0 pixels
+        :param x: int level 0 x coordinate of window
+        :param y: int level 0 y coordinate of window
+        :param w: int buffer width
+        :param h: int buffer height
+        :param downsample: float level 0 pixels per buffer pixel, or
+            (x,y) pair for different scales along each axis
+        :return mask: ndarray (h,w) uint8 mask
+        """
+        mask=np.zeros((int(h),int(w)),dtype=np.uint8)
+        if self.annotations is None:
+            return mask
+        dx,dy=np.broadcast_to(downsample,2)
+        x_max=x+w*dx
+        y_max=y+h*dy
+        class_key=self.annotations.class_key
+        coordinates=self.annotations.intersecting(x,y,x_max,y_max,
+                                                  (x,y),downsample)
+        coordinates={class_key[k]:v for k,v in coordinates.items()}
+        for k in sorted(coordinates.keys()):
+            cv2.fillPoly(mask,coordinates[k],color=int(k))
+        return mask
+
+
+    def generate_feature_masks(self, x, y, w, h, level=0, downsample=None,
+                               labels=None):
+        """
+        Binary mask per annotation label for a window of the slide.
+        Polygons are queried once and each label is filled into its
+        own plane, so overlapping features keep all their pixels as
+        they would with a separate Annotations object per label.
+
+        :param x: int level 0 x coordinate of window
+        :param y: int level 0 y coordinate of window
+        :param w: int window width in pixels at level
+        :param h: int window height in pixels at level
+        :param level: pyramid level of returned masks
+        :param downsample: level 0 pixels per mask pixel, overrides
+            level for resolutions between native levels
+        :param labels: labels to return, defaults to all labels
+        :return masks: ndarray (n,h,w) uint8 masks of 0 and 1
+        """
+        if downsample is None:
+            downsample=self.level_downsamples[level]
+        if labels is None:
+            labels=[] if self.annotations is None else self.annotations.labels
+        masks=np.zeros((len(labels),int(h),int(w)),dtype=np.uint8)
+        if self.annotations is None:
+            return masks
+        dx,dy=np.broadcast_to(downsample,2)
+        coordinates=self.annotations.intersecting(x,y,x+w*dx,y+h*dy,
+                                                  (x,y),downsample)
+        for i, l in enumerate(labels):
+            if l in coordinates:
+                cv2.fillPoly(masks[i],coordinates[l],color=1)
+        return masks
+
+
     @staticmethod
     def resize_border(dim, factor=1, threshold=None, operator='=>'):
         """
@@ -135,16 +592,17 @@ class Slide(OpenSlide):
         :param space: gap between max/min annotation point and border
         :self._border: border dimensions [(x1,y1),(x2,y2)]
         """
-        if self.annotations is None:
+        bounds=None
+        if self.annotations is not None:
+            bounds=self.annotations.index.bounds
+        if bounds is None:
             self._border=[[0,self.dims[0]],[0,self.dims[1]]]
         else:
-            coordinates=self.annotations.annotations
-            coordinates = list(chain(*list(coordinates.values())))
-            coordinates=list(chain(*coordinates))
-            f=lambda x: (min(x)-space, max(x)+space)
-            self._border=list(map(f, list(zip(*coordinates))))
+            x_min,y_min,x_max,y_max=bounds
+            self._border=[(x_min-space,x_max+space),
+                          (y_min-space,y_max+space)]
 
-        mag_factor=Slide.MAG_FACTORS[self.mag]
+        mag_factor=self.level_downsamples[self.mag]
         f=lambda x: (int(x[0]/mag_factor),int(x[1]/mag_factor))
         self._border=list(map(f,self._border))
 
@@ -155,26 +613,24 @@ class Slide(OpenSlide):
     def detect_components(self,level_dims=6,num_component=None,min_size=None):
         """
         Find the largest section on the slide
-        :param down_factor: 
+        :param level_dims: pyramid level of tissue mask
+        :param num_component: number of largest sections to keep
+        :param min_size: minimum section area in mask pixels
         :return image: image containing contour around detected section
         :return self._border: [(x1,x2),(y1,y2)] around detected section
         """
-        new_dims=self.level_dimensions[6]
-        image=np.array(self.get_thumbnail(self.level_dimensions[6]))
-        gray=cv2.cvtColor(image,cv2.COLOR_BGR2GRAY)
-        blur=cv2.bilateralFilter(np.bitwise_not(gray),9,100,100)
-        _,thresh=cv2.threshold(blur,0,255,cv2.THRESH_BINARY+cv2.THRESH_OTSU)
-        contours,_=cv2.findContours(thresh,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_NONE)
+        tissue=self.tissue_mask
+        if tissue.level!=min(level_dims,self.level_count-1):
+            tissue=TissueMask(self,level_dims,cache_dir=self.meta_dir)
+        new_dims=self.level_dimensions[tissue.level]
+        image=self.read_level_array(tissue.level)
+        contours=tissue.contours(0 if min_size is None else min_size)
 
         if num_component is not None:
             idx=sorted([(cv2.contourArea(c),i) for i,c in enumerate(contours)])
             contours=[contours[i] for c, i in idx]
             contours=contours[-num_component:]
 
-        if min_size is not None:
-            contours=list(map(lambda x, y: cv2.contourArea(x),contours))
-            contours=[c for c in contours if c>min_area]
-
         borders=[]
         components=[]
         image_new=image.copy()
@@ -185,7 +641,7 @@ class Slide(OpenSlide):
             x1=round(x_scale*x)
             x2=round(x_scale*(x+w))
             y1=round(y_scale*y)
-            y2=round(y_scale*(y-h))
+            y2=round(y_scale*(y+h))
             self._border=[(x1,x2),(y1,y2)]
             image_new=cv2.rectangle(image_new,(x,y),(x+w,y+h),(0,255,0),2)
             components.append(image_new)
@@ -203,7 +659,8 @@ class Slide(OpenSlide):
                         scale_border=False, 
                         factor=1, 
                         threshold=None, 
-                        operator='=>'):
+                        operator='=>',
+                        mpp=None):
         """
         Extracts specific regions of the slide
         :param mag: magnification level
@@ -215,6 +672,8 @@ class Slide(OpenSlide):
         :param factor:
         :param threshold:
         :param operator:
+        :param mpp: target microns per pixel, overrides mag. Region
+            and mask are returned at this resolution
         :return: extracted region (RGB ndarray)
         """
         if x is None:
@@ -251,13 +710,20 @@ class Slide(OpenSlide):
         if (y_min+y_size)>self.dimensions[1]:
             y_size=self.dimensions[1]-y_min
 
-        x_size_adj=int(x_size/Slide.MAG_FACTORS[mag])
-        y_size_adj=int(y_size/Slide.MAG_FACTORS[mag])
-        region=self.read_region((x_min,y_min),mag,(x_size_adj, y_size_adj))
-        #mask=self.generate_mask()[x_min:x_min+x_size,y_min:y_min+y_size]
-        mask=self.generate_mask()[y_min:y_min+y_size,x_min:x_min+x_size]
+        if mpp is not None:
+            downsample=mpp/self.mpp
+            size=(int(x_size/downsample),int(y_size/downsample))
+            region=self.read_region_mpp((x_min,y_min),mpp,size)
+            mask=self.generate_mask_region(x_min,y_min,size[0],size[1],
+                                           downsample=downsample)
+            return region, mask
+
+        x_size_adj=int(x_size/self.level_downsamples[mag])
+        y_size_adj=int(y_size/self.level_downsamples[mag])
+        region=self.read_region_array((x_min,y_min),mag,(x_size_adj, y_size_adj))
+        mask=self.generate_mask_region(x_min,y_min,x_size,y_size)
 
-        return np.array(region.convert('RGB')), mask
+        return region, mask
 
 
     def save(self, path, size=(2000,2000), mask=False):
@@ -265,14 +731,12 @@ class Slide(OpenSlide):
         Save thumbnail of slide in image file format
         :param path:
         :param size:
-        :param mask:
+        :param mask: save annotation mask rasterized at size
         """
         if mask:
-            cv2.imwrite(path,self._slide_mask)
+            cv2.imwrite(path,mask2rgb(self.mask_thumbnail(size)))
         else:
-            image = self.get_thumbnail(size)
-            image = image.convert('RGB')
-            image = np.array(image)
+            image = self.meta.thumbnail(size)
             cv2.imwrite(path,image)
 
 
@@ -282,24 +746,48 @@ class Annotations():
     Returns dictionary of coordinates of ROIs. Reads annotation 
     files in either xml and json format and returns a dictionary 
     containing x,y coordinates for each region of interest in the 
-    annotation
+    annotation. Polygons are held in columnar arrays, a single int32
+    coordinate array with per-polygon offsets, label ids and bounding
+    boxes. Dictionary views share memory with these arrays.
 
     :param path: string path to annotation file
     :param annotation_type: file type
     :param labels: list of ROI names ['roi1',roi2']
     :param _annotations: dictonary with return files
                       {roi1:[[x1,y1],[x2,y2],...[xn,yn],...roim:[]}
+    :param _coords: ndarray (n,2) int32 coordinates of all polygons
+    :param _offsets: ndarray (p+1) start of each polygon in _coords
+    :param _label_ids: ndarray (p) index of polygon label in labels
+    :param _bboxes: ndarray (p,4) polygon [x_min,y_min,x_max,y_max]
+    :param cache_dir: directory for binary cache of parsed annotations
     """
-    def __init__(self, path, source,labels=[], encode=False):
+    CACHE_ARRAYS=('coords','offsets','label_ids','bboxes')
+
+    def __init__(self, path, source,labels=[], encode=False, cache_dir=None):
         self.paths=path if isinstance(path,list) else [path]
         self.source=source
-        self.labels=labels
+        self.labels=list(labels) if labels is not None else []
         self.encode=encode
+        self.cache_dir=cache_dir
         self._annotations=None
-        self._generate_annotations()
+        cache_path=self._cache_path()
+        if not self._load_cache(cache_path):
+            self._generate_annotations()
+            self._save_cache(cache_path)
+
+    def __getstate__(self):
+        #views and index are rebuilt from the columnar arrays
+        state=self.__dict__.copy()
+        state.pop('_views',None)
+        state.pop('_index',None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_derived()
 
     def __repr__(self):
-        numbers=[len(v) for k, v in self._annotations.items()]
+        numbers=list(self.numbers.values())
         print(numbers)
         df=pd.DataFrame({"classes":self.labels,"number":numbers})
         return str(df)
@@ -321,6 +809,21 @@ class Annotations():
             annotations=self._annotations
         return annotations
 
+    @property
+    def _annotations(self):
+        if self._views is None:
+            return None
+        annotations={}
+        for l, v in zip(self._label_ids, self._views):
+            annotations.setdefault(self.labels[l],[]).append(v)
+        return annotations
+
+    @_annotations.setter
+    def _annotations(self, annotations):
+        self._pack(annotations if annotations is not None else {})
+        if annotations is None:
+            self._views=None
+
     @property
     def class_key(self):
         if self.labels is None:
@@ -330,8 +833,164 @@ class Annotations():
 
     @property
     def numbers(self):
-        numbers=[len(v) for k, v in self._annotations.items()]
-        return dict(zip(self.labels,numbers))
+        numbers=np.bincount(self._label_ids,minlength=len(self.labels))
+        return dict(zip(self.labels,numbers.tolist()))
+
+    @property
+    def bboxes(self):
+        return self._bboxes
+
+    @property
+    def index(self):
+        if self._index is None:
+            self.build_index()
+        return self._index
+
+
+    def _pack(self, annotations):
+        """
+        Pack dictionary of polygons into columnar arrays. Labels
+        not already in self.labels are appended
+        :param annotations: dict {label:[polygon,...]}
+        """
+        polygons=[]
+        label_ids=[]
+        for k, v in annotations.items():
+            if k not in self.labels:
+                self.labels.append(k)
+            for a in v:
+                a=np.asarray(a,dtype=np.int32).reshape(-1,2)
+                if len(a)==0:
+                    continue
+                polygons.append(a)
+                label_ids.append(self.labels.index(k))
+        lengths=[len(a) for a in polygons]
+        self._offsets=np.zeros(len(polygons)+1,dtype=np.int64)
+        self._offsets[1:]=np.cumsum(lengths,dtype=np.int64)
+        if len(polygons)>0:
+            self._coords=np.ascontiguousarray(np.concatenate(polygons))
+        else:
+            self._coords=np.zeros((0,2),dtype=np.int32)
+        self._label_ids=np.array(label_ids,dtype=np.int32)
+        self._set_derived()
+
+
+    def _set_derived(self, bboxes=None):
+        """
+        Recompute polygon views and bounding boxes from columnar
+        arrays after they change
+        :param bboxes: known bounding boxes, skips the pass over
+            every vertex
+        """
+        self._views=np.split(self._coords,self._offsets[1:-1])
+        if len(self._label_ids)==0:
+            self._views=[]
+        starts=self._offsets[:-1]
+        if bboxes is not None:
+            self._bboxes=bboxes
+        elif len(starts)>0:
+            mins=np.minimum.reduceat(self._coords,starts,axis=0)
+            maxs=np.maximum.reduceat(self._coords,starts,axis=0)
+            self._bboxes=np.hstack((mins,maxs)).astype(np.int32)
+        else:
+            self._bboxes=np.zeros((0,4),dtype=np.int32)
+        self._index=None
+
+
+    def _select(self, keep):
+        """
+        Keep subset of polygons given boolean mask over polygons
+        :param keep: ndarray (p) boolean
+        """
+        idx=np.flatnonzero(keep)
+        lengths=np.diff(self._offsets)[idx]
+        self._coords=np.ascontiguousarray(self._coords[self._gather(idx)])
+        self._offsets=np.zeros(len(idx)+1,dtype=np.int64)
+        self._offsets[1:]=np.cumsum(lengths)
+        self._label_ids=self._label_ids[idx]
+        self._set_derived()
+
+
+    def _gather(self, idx):
+        """
+        Coordinate row positions of selected polygons
+        :param idx: ndarray polygon indices
+        :return pos: ndarray positions into self._coords
+        """
+        starts=self._offsets[idx]
+        lengths=self._offsets[idx+1]-starts
+        shift=starts-np.concatenate(([0],np.cumsum(lengths)[:-1]))
+        return np.repeat(shift,lengths)+np.arange(lengths.sum())
+
+
+    def polygons(self, idx=None, origin=(0,0), downsample=1):
+        """
+        Polygons shifted by origin and scaled by downsample, with
+        the transform applied to all selected coordinates at once
+        :param idx: polygon indices. Defaults to all polygons
+        :param origin: level 0 (x,y) origin
+        :param downsample: level 0 pixels per output pixel, scalar
+            or (x,y) pair
+        :return polygons: list of int32 ndarray polygons
+        """
+        if idx is None:
+            idx=np.arange(len(self._label_ids))
+        idx=np.asarray(idx,dtype=np.int64)
+        if len(idx)==0:
+            return []
+        lengths=self._offsets[idx+1]-self._offsets[idx]
+        coords=self._coords[self._gather(idx)]
+        if tuple(origin)!=(0,0) or np.any(np.asarray(downsample)!=1):
+            coords=np.round((coords-np.asarray(origin))/np.asarray(downsample))
+            coords=coords.astype(np.int32)
+        return np.split(coords,np.cumsum(lengths)[:-1])
+
+
+    def build_index(self, cell_size=None):
+        """
+        Build uniform grid index over polygon bounding boxes.
+        Built once and reused by window and point queries
+        :param cell_size: grid cell size in level 0 pixels
+        :return self._index: GridIndex
+        """
+        self._index=GridIndex(self._bboxes,cell_size)
+        return self._index
+
+
+    def intersecting(self, x_min, y_min, x_max, y_max, 
+                     origin=(0,0), downsample=1):
+        """
+        polygons whose bounding box intersects rectangle
+        :param x_min: level 0 min x
+        :param y_min: level 0 min y
+        :param x_max: level 0 max x
+        :param y_max: level 0 max y
+        :param origin: level 0 (x,y) origin of returned polygons
+        :param downsample: scale of returned polygons
+        :return polygons: dict {label:[ndarray polygon,...]}
+        """
+        idx=self.index.query(x_min,y_min,x_max,y_max)
+        polygons={}
+        transformed=self.polygons(idx,origin,downsample)
+        for l, a in zip(self._label_ids[idx],transformed):
+            polygons.setdefault(self.labels[l],[]).append(a)
+        return polygons
+
+
+    def label_at(self, x, y):
+        """
+        label of annotation containing point. Where polygons
+        overlap the label drawn last in the mask is returned
+        :param x: level 0 x coordinate
+        :param y: level 0 y coordinate
+        :return label: label or None if point not annotated
+        """
+        ids=[self._label_ids[i] for i in self.index.query_point(x,y)
+             if cv2.pointPolygonTest(self._views[i],
+                                     (float(x),float(y)),False)>=0]
+        if len(ids)==0:
+            return None
+        return self.labels[max(ids)]
 
 
     def _generate_annotations(self):
@@ -339,21 +998,82 @@ class Annotations():
         Calls appropriate method for file type.
         return: annotations: dictionary of coordinates
         """
-        self._annotations={}
+        parsed={}
         if not isinstance(self.paths,list):
             self._paths=[self.paths] 
         if self.source is not None:
             for p in self.paths:
                 annotations=getattr(self,'_'+self.source)(p)
                 for k, v in annotations.items():
-                    if k in self._annotations:
-                        self._annotations[k].append(v)
-                    else:
-                        self._annotations[k]=v
-        if len(self.labels)>0:
-            self._annotations=self.filter_labels(self.labels)
-        else:
-            self.labels=list(self._annotations.keys())
+                    parsed.setdefault(k,[]).extend(v)
+        labels=list(self.labels)
+        self.labels=[]
+        self._annotations=parsed
+        if len(labels)>0:
+            self.filter_labels(labels)
+
+
+    def _cache_path(self):
+        """
+        cache location keyed by source paths, modification times,
+        source type and requested labels
+        :return path: cache directory or None if caching disabled
+        """
+        if self.cache_dir is None:
+            return None
+        key=[self.source,list(self.labels)]
+        for p in self.paths:
+            stat=os.stat(p)
+            key.append([os.path.abspath(p),stat.st_mtime_ns,stat.st_size])
+        key=hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir,key)
+
+
+    def _load_cache(self, path):
+        """
+        load memory-mapped columnar arrays from cache
+        :param path: cache directory
+        :return boolean: cache hit
+        """
+        if path is None or not os.path.isdir(path):
+            return False
+        with open(os.path.join(path,'labels.json')) as json_file:
+            self.labels=json.load(json_file)
+        arrays={a:np.load(os.path.join(path,a+'.npy'),mmap_mode='r')
+                for a in Annotations.CACHE_ARRAYS}
+        self._coords=arrays['coords']
+        self._offsets=arrays['offsets']
+        self._label_ids=arrays['label_ids']
+        self._set_derived(arrays['bboxes'])
+        return True
+
+
+    def _save_cache(self, path):
+        """
+        save columnar arrays as .npy files (npz members cannot be
+        memory-mapped). Written to a temporary directory and renamed
+        so concurrent jobs never see a partial cache
+        :param path: cache directory
+        """
+        if path is None or os.path.isdir(path):
+            return
+        os.makedirs(self.cache_dir,exist_ok=True)
+        tmp_path=tempfile.mkdtemp(dir=self.cache_dir)
+        arrays={'coords':self._coords,'offsets':self._offsets,
+                'label_ids':self._label_ids,'bboxes':self._bboxes}
+        try:
+            for k, v in arrays.items():
+                np.save(os.path.join(tmp_path,k+'.npy'),v)
+            with open(os.path.join(tmp_path,'labels.json'),'w') as json_file:
+                json.dump(self.labels,json_file)
+            share_mode(tmp_path,directory=True)
+            try:
+                os.rename(tmp_path,path)
+            except OSError:
+                #another job wrote the cache first
+                pass
+        finally:
+            shutil.rmtree(tmp_path,ignore_errors=True)
         
 
     def filter_labels(self, labels):
@@ -362,11 +1082,12 @@ class Annotations():
         :param labels: label list to remove
         :return annotations: filtered annotation dictionary
         """
+        labels=list(labels)
+        remap=[labels.index(l) if l in labels else -1 for l in self.labels]
+        label_ids=np.array(remap+[-1],dtype=np.int32)[self._label_ids]
         self.labels=labels
-        keys = list(self._annotations.keys())
-        for k in keys:
-            if k not in labels:
-                del self._annotations[k]
+        self._label_ids=label_ids
+        self._select(label_ids>=0)
         return self._annotations
 
 
@@ -375,9 +1096,15 @@ class Annotations():
         rename annotation labels
         :param names: dictionary {current_labels:new_labels}
         """
-        for k,v in names.items():
-            self._annotations[v]=self._annotations.pop(k)
-        self.labels=list(self._annotations.keys())        
+        renamed=[k for k in names if k in self.labels]
+        labels=[l for l in self.labels if l not in renamed]
+        labels=labels+[names[k] for k in renamed]
+        remap=np.array([labels.index(names.get(l,l)) for l in self.labels],
+                       dtype=np.int32)
+        if len(remap)>0:
+            self._label_ids=remap[self._label_ids]
+        self.labels=labels
+        self._index=None
     
 
     def encode_keys(self):
@@ -394,22 +1121,7 @@ class Annotations():
         :param path:
         :return annotations: dict of coordinates
         """
-        tree=ET.parse(path)
-        root=tree.getroot()
-        anns=root.findall('Annotation')
-        labels=list(root.iter('Annotation'))
-        labels=list(set([i.attrib['Name'] for i in labels]))
-        #self.labels.extend(labels)
-        annotations={l:[] for l in labels}
-        for i in anns:
-            label=i.attrib['Name']
-            instances=list(i.iter('Vertices'))
-            for j in instances:
-                coordinates=list(j.iter('Vertex'))
-                coordinates=[[c.attrib['X'],c.attrib['Y']] for c in coordinates]
-                coordinates=[[round(float(c[0])),round(float(c[1]))] for c in coordinates]
-                annotations[label]=annotations[label]+[coordinates]
-        return annotations
+        return self._iterparse(path,'Name','Vertices','Vertex',depth=1)
 
 
     def _asap(self,path):
@@ -418,19 +1130,63 @@ class Annotations():
         :param path:
         :return annotations: dict of coordinates
         """
-        tree=ET.parse(path)
-        root=tree.getroot()
-        ns=root[0].findall('Annotation')
-        labels=list(root.iter('Annotation'))
-        labels=list(set([i.attrib['PartOfGroup'] for i in labels]))
+        return self._iterparse(path,'PartOfGroup','Annotation','Coordinate',depth=2)
+
+
+    @staticmethod
+    def _iterparse(path, label_attr, polygon_tag, vertex_tag, depth):
+        """
+        Single pass streaming parse of xml annotations. Vertices are
+        written straight into a growing numpy buffer and elements
+        are cleared once read. Labels are collected from every
+        Annotation element, polygons only from Annotation elements
+        at depth (within the first child of root when depth>1)
+        :param path: xml file path
+        :param label_attr: Annotation attribute holding label
+        :param polygon_tag: element enclosing one polygon
+        :param vertex_tag: element with X and Y attributes
+        :param depth: depth of parsed Annotation elements below root
+        :return annotations: dict of int32 ndarray polygons
+        """
+        buf=np.empty((4096,2),dtype=np.float64)
+        n=0
+        labels={}
+        polygons=[]
+        level=-1
+        children=0
+        label=None
+        start=None
+        for event, elem in ET.iterparse(path,events=('start','end')):
+            if event=='start':
+                level+=1
+                if level==1:
+                    children+=1
+                if elem.tag=='Annotation':
+                    labels.setdefault(elem.attrib[label_attr],None)
+                    if level==depth and (depth==1 or children==1):
+                        label=elem.attrib[label_attr]
+                if elem.tag==polygon_tag and label is not None:
+                    start=n
+                if elem.tag==vertex_tag and start is not None:
+                    if n==len(buf):
+                        buf=np.resize(buf,(2*n,2))
+                    buf[n]=(float(elem.attrib['X']),float(elem.attrib['Y']))
+                    n+=1
+            else:
+                if elem.tag==polygon_tag and start is not None:
+                    polygons.append((label,start,n))
+                    start=None
+                if elem.tag=='Annotation' and level==depth:
+                    label=None
+                    elem.clear()
+                elif elem.tag==vertex_tag:
+                    elem.clear()
+                level-=1
+
+        coordinates=np.rint(buf[:n]).astype(np.int32)
         annotations={l:[] for l in labels}
-        for i in ns:
-            coordinates=list(i.iter('Coordinate'))
-            coordinates=[[float(c.attrib['X']),float(c.attrib['Y'])] for c in coordinates]
-            coordinates=[[round(c[0]),round(c[1])] for c in coordinates]
-            label=i.attrib['PartOfGroup']
-            annotations[label]=annotations[label]+[coordinates]
-        #annotations = {self.class_key[k]: v for k,v in annotations.items()}
+        for l, i, j in polygons:
+            annotations[l].append(coordinates[i:j])
         return annotations
 
 
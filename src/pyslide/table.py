@@ -0,0 +1,240 @@
+"""
+table.py: contains PatchTable class
+
+PatchTable class - columnar table of patch coordinates. Holds int32 x/y
+arrays, a float label array (nan when unlabelled), a boolean keep mask
+and any extra numeric columns. Names are formatted lazily as
+slidename_x_y. Filters are boolean mask operations and tables can be
+sliced, concatenated across slides and saved to npz or parquet.
+"""
+
+import numpy as np
+import pandas as pd
+
+__author__='Gregory Verghese'
+__email__='gregory.verghese@gmail.com'
+
+
+class PatchTable():
+    """
+    Columnar patch table. Only rows with keep set are visible to
+    len, iteration and indexing. Rows returned by iteration and
+    integer indexing are dict copies, so assigning to them does not
+    change the table; write columns through label or set_column.
+
+    :param x: level 0 x coordinates
+    :param y: level 0 y coordinates
+    :param name: slide name or list of slide names, one per row
+    :param label: patch labels, nan when unlabelled
+    :param columns: dict of extra numeric columns
+    """
+    def __init__(self, x=(), y=(), name='', label=None, columns=None):
+        self.x=np.asarray(x,dtype=np.int32).ravel()
+        self.y=np.asarray(y,dtype=np.int32).ravel()
+        n=len(self.x)
+        if isinstance(name,str):
+            self.slides=[name]
+            self.slide_id=np.zeros(n,dtype=np.int32)
+        else:
+            self.slides,self.slide_id=np.unique(np.asarray(name,dtype=str),
+                                                return_inverse=True)
+            self.slides=self.slides.tolist()
+            self.slide_id=self.slide_id.astype(np.int32)
+        if label is None:
+            label=np.full(n,np.nan)
+        self.label=np.asarray(label,dtype=np.float64)
+        self.keep=np.ones(n,dtype=bool)
+        self.columns={k:np.asarray(v) for k, v in (columns or {}).items()}
+
+
+    def __len__(self):
+        return int(self.keep.sum())
+
+
+    def __repr__(self):
+        return f'PatchTable(patches: {len(self)}, removed: {len(self.keep)-len(self)}, slides: {len(self.slides)})'
+
+
+    def __iter__(self):
+        for i in self.index:
+            yield self._row(i)
+
+
+    def __getitem__(self, key):
+        """
+        int returns a row dict copy, slices and index or boolean
+        arrays over visible rows return a new PatchTable
+        """
+        idx=self.index
+        if isinstance(key,(int,np.integer)):
+            return self._row(idx[key])
+        return self.take(idx[key])
+
+
+    @property
+    def index(self):
+        """
+        positions of visible rows
+        """
+        return np.flatnonzero(self.keep)
+
+
+    @property
+    def names(self):
+        return [self._name(i) for i in self.index]
+
+
+    def _name(self, i):
+        return self.slides[self.slide_id[i]]+'_'+str(self.x[i])+'_'+str(self.y[i])
+
+
+    def _row(self, i):
+        row={'name':self._name(i),'x':int(self.x[i]),'y':int(self.y[i]),
+             'label':self.label[i]}
+        for k, v in self.columns.items():
+            row[k]=v[i]
+        return row
+
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        build table from list of {'name','x','y','label'} dicts
+        :param records: list of patch dicts
+        :return table: PatchTable
+        """
+        records=list(records)
+        x=[r['x'] for r in records]
+        y=[r['y'] for r in records]
+        name=[r['name'][:-len('_'+str(r['x'])+'_'+str(r['y']))]
+              for r in records]
+        label=[r.get('label',np.nan) for r in records]
+        return cls(x,y,name if len(records)>0 else '',label)
+
+
+    def take(self, idx):
+        """
+        new table holding rows at positions idx
+        :param idx: ndarray of row positions
+        :return table: PatchTable
+        """
+        table=PatchTable()
+        table.x=self.x[idx]
+        table.y=self.y[idx]
+        table.slides=list(self.slides)
+        table.slide_id=self.slide_id[idx]
+        table.label=self.label[idx]
+        table.keep=np.ones(len(table.x),dtype=bool)
+        table.columns={k:v[idx] for k, v in self.columns.items()}
+        return table
+
+
+    def compact(self):
+        """
+        drop removed rows
+        :return self: PatchTable
+        """
+        table=self.take(self.index)
+        self.__dict__.update(table.__dict__)
+        return self
+
+
+    def filter(self, mask):
+        """
+        remove visible rows where mask is False
+        :param mask: boolean array aligned with visible rows
+        :return removed: number of rows removed
+        """
+        mask=np.asarray(mask,dtype=bool)
+        idx=self.index
+        self.keep[idx[~mask]]=False
+        return int((~mask).sum())
+
+
+    def set_column(self, name, values):
+        """
+        add or overwrite an extra column for visible rows
+        :param name: column name
+        :param values: array aligned with visible rows
+        """
+        values=np.asarray(values)
+        if name not in self.columns:
+            column=np.zeros(len(self.keep),dtype=values.dtype)
+            if values.dtype.kind=='f':
+                column[:]=np.nan
+            self.columns[name]=column
+        self.columns[name][self.index]=values
+
+
+    @staticmethod
+    def concat(tables):
+        """
+        concatenate visible rows of several tables
+        :param tables: list of PatchTable
+        :return table: PatchTable, empty when tables is empty
+        """
+        tables=[t.take(t.index) for t in tables]
+        if len(tables)==0:
+            return PatchTable()
+        slides=sorted(set(s for t in tables for s in t.slides))
+        table=PatchTable()
+        table.slides=slides
+        table.x=np.concatenate([t.x for t in tables])
+        table.y=np.concatenate([t.y for t in tables])
+        table.slide_id=np.concatenate([np.searchsorted(slides,
+                                       np.asarray(t.slides))[t.slide_id]
+                                       for t in tables]).astype(np.int32)
+        table.label=np.concatenate([t.label for t in tables])
+        table.keep=np.ones(len(table.x),dtype=bool)
+        keys=set(tables[0].columns).intersection(*[t.columns for t in tables])
+        table.columns={k:np.concatenate([t.columns[k] for t in tables])
+                       for k in keys}
+        return table
+
+
+    def df(self):
+        """
+        dataframe of visible rows
+        :return df: pd.DataFrame
+        """
+        idx=self.index
+        df=pd.DataFrame({'names':self.names,'x':self.x[idx],'y':self.y[idx],
+                         'labels':self.label[idx]})
+        for k, v in self.columns.items():
+            df[k]=v[idx]
+        return df
+
+
+    def to_parquet(self, path):
+        self.df().to_parquet(path)
+
+
+    def to_npz(self, path):
+        """
+        save all rows, keep mask included
+        :param path: npz file path
+        """
+        columns={'column_'+k:v for k, v in self.columns.items()}
+        np.savez(path,x=self.x,y=self.y,slide_id=self.slide_id,
+                 slides=np.asarray(self.slides,dtype=str),label=self.label,
+                 keep=self.keep,**columns)
+
+
+    @classmethod
+    def from_npz(cls, path):
+        """
+        load table saved by to_npz
+        :param path: npz file path
+        :return table: PatchTable
+        """
+        data=np.load(path)
+        table=cls()
+        table.x=data['x']
+        table.y=data['y']
+        table.slides=data['slides'].tolist()
+        table.slide_id=data['slide_id']
+        table.label=data['label']
+        table.keep=data['keep']
+        table.columns={k[len('column_'):]:data[k] for k in data.files
+                       if k.startswith('column_')}
+        return table
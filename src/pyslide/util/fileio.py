@@ -0,0 +1,39 @@
+'''
+fileio.py: helpers for caches written next to slides and shared
+between users and processes. Files are written to a temporary name
+and renamed into place, with the permissions a plainly created file
+would have rather than the private mode tempfile gives them
+'''
+import os
+import tempfile
+
+
+def share_mode(path, directory=False):
+    """
+    set the mode a normally created file (0o666) or directory (0o777)
+    would get under the current umask
+    :param path: file or directory path
+    :param directory: path is a directory
+    """
+    umask=os.umask(0)
+    os.umask(umask)
+    os.chmod(path,(0o777 if directory else 0o666)&~umask)
+
+
+def atomic_write(path, dump, mode='wb'):
+    """
+    write file via a temporary file in the same directory renamed
+    into place. The temporary file is removed if writing fails
+    :param path: destination file path
+    :param dump: function writing to an open file
+    :param mode: file mode
+    """
+    fd,tmp_path=tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd,mode) as f:
+            dump(f)
+        share_mode(tmp_path)
+        os.replace(tmp_path,path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,104 @@
+'''
+spatial.py: uniform grid index over axis aligned bounding boxes. Used
+to find annotation polygons near a window or point without scanning
+every polygon on the slide
+'''
+import numpy as np
+
+
+class GridIndex():
+    """
+    Uniform grid over bounding boxes. Each box is registered in every
+    cell it overlaps so rectangle and point queries only visit the
+    boxes in the cells they touch.
+
+    :param bboxes: ndarray (n,4) of [x_min,y_min,x_max,y_max]
+    :param cell_size: int grid cell size. Defaults to twice the median
+        box side so most boxes fall in a handful of cells
+    """
+    def __init__(self, bboxes, cell_size=None):
+        self.bboxes=np.asarray(bboxes,dtype=np.int64).reshape(-1,4)
+        if cell_size is None:
+            cell_size=self._default_cell_size(self.bboxes)
+        self.cell_size=int(max(cell_size,1))
+        self._cells={}
+        self._build()
+
+
+    def __len__(self):
+        return len(self.bboxes)
+
+
+    def __repr__(self):
+        return f'GridIndex(boxes: {len(self)}, cells: {len(self._cells)}, cell_size: {self.cell_size})'
+
+
+    @staticmethod
+    def _default_cell_size(bboxes):
+        if len(bboxes)==0:
+            return 1
+        sides=np.maximum(bboxes[:,2]-bboxes[:,0],bboxes[:,3]-bboxes[:,1])
+        return int(2*np.median(sides))+1
+
+
+    @property
+    def bounds(self):
+        """
+        bounding box of all boxes in the index
+        :return [x_min,y_min,x_max,y_max] or None if empty
+        """
+        if len(self.bboxes)==0:
+            return None
+        return [int(self.bboxes[:,0].min()),int(self.bboxes[:,1].min()),
+                int(self.bboxes[:,2].max()),int(self.bboxes[:,3].max())]
+
+
+    def _cell_range(self, x_min, y_min, x_max, y_max):
+        c=self.cell_size
+        return (int(x_min//c),int(y_min//c),int(x_max//c),int(y_max//c))
+
+
+    def _build(self):
+        """
+        register each box in the cells it overlaps
+        """
+        for i, box in enumerate(self.bboxes):
+            cx1,cy1,cx2,cy2=self._cell_range(*box)
+            for cx in range(cx1,cx2+1):
+                for cy in range(cy1,cy2+1):
+                    self._cells.setdefault((cx,cy),[]).append(i)
+
+
+    def query(self, x_min, y_min, x_max, y_max):
+        """
+        indices of boxes intersecting rectangle (inclusive bounds)
+        :param x_min: int min x
+        :param y_min: int min y
+        :param x_max: int max x
+        :param y_max: int max y
+        :return idx: sorted ndarray of box indices
+        """
+        cx1,cy1,cx2,cy2=self._cell_range(x_min,y_min,x_max,y_max)
+        if (cx2-cx1+1)*(cy2-cy1+1)>len(self._cells):
+            candidates=[v for (cx,cy),v in self._cells.items()
+                        if cx1<=cx<=cx2 and cy1<=cy<=cy2]
+        else:
+            candidates=[self._cells.get((cx,cy),()) for cx in range(cx1,cx2+1)
+                        for cy in range(cy1,cy2+1)]
+        candidates=[i for c in candidates for i in c]
+        if len(candidates)==0:
+            return np.zeros(0,dtype=np.int64)
+        idx=np.unique(np.array(candidates,dtype=np.int64))
+        b=self.bboxes[idx]
+        hit=(b[:,0]<=x_max)&(b[:,2]>=x_min)&(b[:,1]<=y_max)&(b[:,3]>=y_min)
+        return idx[hit]
+
+
+    def query_point(self, x, y):
+        """
+        indices of boxes containing point
+        :param x: x coordinate
+        :param y: y coordinate
+        :return idx: sorted ndarray of box indices
+        """
+        return self.query(x,y,x,y)
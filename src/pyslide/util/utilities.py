@@ -1,23 +1,43 @@
 '''
 utilities.py: useful functions
 '''
+import copy
 import cv2
 import numpy as np
 import xml.etree.ElementTree as ET
 import seaborn as sns
 from itertools import chain
 
-
-def mask2rgb(mask):
-    n_classes=len(np.unique(mask))
-    colors=sns.color_palette('hls',n_classes)
-    rgb_mask=np.zeros(mask.shape+(3,))
-    for c in range(1,n_classes+1):
-        t=(mask==c)
-        rgb_mask[:,:,0][t]=colors[c-1][0]
-        rgb_mask[:,:,1][t]=colors[c-1][1]
-        rgb_mask[:,:,2][t]=colors[c-1][2]
-    return rgb_mask
+from pyslide.mask import TissueMask
+from pyslide.table import PatchTable
+
+
+def mask2rgb(mask, n_classes=None, normalise=False):
+    """
+    colour a class mask through an 'hls' palette lookup table.
+    Class c in 1..n_classes gets palette colour c-1, everything
+    else stays black. Returns uint8 0-255 colours ready for
+    blending and saving; earlier versions returned float64 0-1,
+    which normalise=True still gives
+    :param mask: ndarray integer class mask
+    :param n_classes: palette size. Defaults to the number of
+        distinct values in mask
+    :param normalise: return float64 colours in 0-1
+    :return rgb_mask: ndarray (h,w,3) uint8, float64 if normalise
+    """
+    mask=np.asarray(mask)
+    if mask.dtype==np.uint8:
+        counts=np.bincount(mask.ravel(),minlength=256)
+        n=int((counts>0).sum()) if n_classes is None else n_classes
+        idx=mask
+    else:
+        n=len(np.unique(mask)) if n_classes is None else n_classes
+        idx=np.where((mask>=1)&(mask<=n),mask,0).astype(np.intp)
+    lut=np.zeros((max(256,n+1),3))
+    lut[1:n+1]=np.array(sns.color_palette('hls',n)).reshape(-1,3)
+    if not normalise:
+        lut=np.rint(lut*255).astype(np.uint8)
+    return lut[idx]
 
 
 def draw_boundary(annotations, offset=100):
@@ -39,56 +59,55 @@ def oneHotToMask(onehot):
     return multimask
 
 
-#can we sample and return a new patching object
-def sample_patches(patch,n,replacement=False):
-    
+def sample_patches(patch, n, replacement=False, seed=0, stratify=False):
+    """
+    sampled copy of a Patch object, the original is unchanged
+    :param patch: Patch object with generated patches
+    :param n: number of patches, per label when stratify
+    :param replacement: sample with replacement (not stratified)
+    :param seed: int seed
+    :param stratify: sample n per label
+    :return new_patch: Patch object
+    """
+    new_patch=copy.copy(patch)
+    new_patch.patches=patch.patches.take(patch.patches.index)
     if replacement:
-        patches=random.choice(patch._patches,n)
+        rng=np.random.default_rng(seed)
+        idx=rng.integers(0,new_patch.number,n)
+        new_patch.patches=new_patch.patches.take(idx)
     else:
-        patches=random.sample(patch._patches,n)
-
-    new_patch =  Patch(patch.slide,
-                       patch.size,
-                       patch.mag_level,
-                       patch.border,  
-                       patch.step)
-
-    new_patch.patches=patches
-    return new_patches
+        new_patch.sample(n,seed,stratify)
+    return new_patch
+
+
+def sample_cohort(patches, n, seed=0, stratify=False, **kwargs):
+    """
+    per slide quota sample across a cohort. Each slide is sampled
+    with Patch.sample so the subset is regenerated by the same seed
+    :param patches: list of Patch objects
+    :param n: quota per slide, or dict {slide name:quota}
+    :param seed: int seed
+    :param stratify: quota per label within each slide
+    :param kwargs: Patch.sample arguments (step to stream grids)
+    :return table: PatchTable of sampled patches
+    """
+    for p in patches:
+        quota=n.get(p.slide.name,0) if isinstance(n,dict) else n
+        p.sample(quota,seed,stratify,**kwargs)
+    return PatchTable.concat([p.patches for p in patches])
 
 
 def detect_tissue_section(slide):
-
-    bilateral1_args={"d":9,"sigmaColor":10000,"sigmaSpace":150}
-    bilateral2_args={"d":90,"sigmaColor":5000,"sigmaSpace":5000}
-    bilateral3_args={"d":90,"sigmaColor":10000,"sigmaSpace":10000}
-    bilateral4_args={"d":90,"sigmaColor":10000,"sigmaSpace":100}
-    thresh1_args={"thresh":0,"maxval":255,"type":cv2.THRESH_TRUNC+cv2.THRESH_OTSU}
-    thresh2_args={"thresh":0,"maxval":255,"type":cv2.THRESH_OTSU}
-
-    slide=slide.get_thumbnail(slide.level_dimensions[6])
-    slide=np.array(slide.convert('RGB'))
-    img_hsv=cv2.cvtColor(slide,cv2.COLOR_RGB2HSV)
-    lower_red=np.array([120,0,0])
-    upper_red=np.array([180,255,255])
-    mask=cv2.inRange(img_hsv,lower_red,upper_red)
-    img_hsv=cv2.cvtColor(img_hsv,cv2.COLOR_HSV2RGB)
-    m=cv2.bitwise_and(slide,slide,mask=mask)
-    im_fill=np.where(m==0,233,m)
-    mask=np.zeros(slide.shape)
-    gray=cv2.cvtColor(im_fill,cv2.COLOR_BGR2GRAY)
-    blur1=cv2.bilateralFilter(np.bitwise_not(gray),**bilateral1_args)
-    blur2=cv2.bilateralFilter(np.bitwise_not(blur1),**bilateral2_args)
-    blur3=cv2.bilateralFilter(np.bitwise_not(blur2),**bilateral3_args)
-    blur4=cv2.bilateralFilter(np.bitwise_not(blur3),**bilateral4_args)
-    blur_final=255-blur4
-
-    _,thresh=cv2.threshold(blur_final,**thresh1_args)
-    _,thresh=cv2.threshold(thresh,**thresh2_args)
-
-    contours,_=cv2.findContours(thresh,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_NONE)
-    contours=list(filter(lambda x: cv2.contourArea(x) > 4000, contours))
-    return contours
+    """
+    tissue contours on level 6 thumbnail, using the slide's cached
+    TissueMask when available
+    :param slide: pyslide.Slide or openslide.OpenSlide object
+    :return contours: contours with area > 4000 pixels
+    """
+    tissue=getattr(slide,'tissue_mask',None)
+    if tissue is None:
+        tissue=TissueMask(slide)
+    return tissue.contours(min_area=4000)
 
 
 def match_annotations_to_tissue_contour(
@@ -96,14 +115,23 @@ def match_annotations_to_tissue_contour(
         annotations,
         ds
         ):
-    target=None
+    """
+    return first tissue contour containing an annotation point
+    :param contours: tissue contours at downsample ds
+    :param annotations: list of level 0 points or Annotations object.
+        With Annotations only polygons inside the bounding box of
+        each contour are tested
+    :param ds: contour downsample factor
+    :return c: matched contour
+    """
     for c in contours:
-        for p in annotations:
+        points=annotations
+        if hasattr(annotations,'intersecting'):
+            x,y,w,h=cv2.boundingRect(c)
+            polygons=annotations.intersecting(x*ds,y*ds,(x+w)*ds,(y+h)*ds)
+            points=chain(*chain(*polygons.values()))
+        for p in points:
             p=(int(p[0]/ds),int(p[1]/ds))
             if cv2.pointPolygonTest(c, p, False)==1: 
-                target=1
-                break
-        if target==1:
-            break
+                return c
     return c
-
@@ -0,0 +1,116 @@
+'''
+conftest.py: small synthetic pyramidal slide and QuPath annotations
+shared by the pyslide tests. The slide is a tiled tiff written with
+tifffile and read through openslide's generic tiff backend
+'''
+import os
+import sys
+import json
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','src'))
+
+tifffile=pytest.importorskip('tifffile')
+pytest.importorskip('openslide')
+
+WIDTH,HEIGHT=2048,1536
+LEVELS=5
+#(cx,cy,radius,label) of the annotated regions
+REGIONS=[(700,650,180,'GC'),(1150,800,120,'GC'),(1600,600,90,'GC'),
+         (500,900,220,'sinus'),(760,700,60,'sinus')]
+
+
+def _image():
+    rng=np.random.default_rng(0)
+    image=np.full((HEIGHT,WIDTH,3),235,np.uint8)
+    cv2.ellipse(image,(800,750),(550,450),0,0,360,(180,90,170),-1)
+    cv2.circle(image,(1600,620),230,(150,60,160),-1)
+    noise=rng.integers(0,40,(HEIGHT,WIDTH,1),dtype=np.uint8)
+    return np.where(image<235,image-noise,image).astype(np.uint8)
+
+
+def _polygon(cx, cy, r, n=40):
+    a=np.linspace(0,2*np.pi,n,endpoint=False)
+    points=[[float(cx+r*np.cos(t)),float(cy+r*np.sin(t))] for t in a]
+    return points+[points[0]]
+
+
+def _write_slide(path):
+    level=_image()
+    with tifffile.TiffWriter(path) as tif:
+        for i in range(LEVELS):
+            tif.write(level,tile=(256,256),photometric='rgb',compression='zlib',
+                      subfiletype=0 if i==0 else 1)
+            level=cv2.resize(level,(level.shape[1]//2,level.shape[0]//2),
+                             interpolation=cv2.INTER_AREA)
+
+
+def _write_qupath(path):
+    features=[{'type':'Feature',
+               'geometry':{'type':'Polygon','coordinates':[_polygon(cx,cy,r)]},
+               'properties':{'classification':{'name':label}}}
+              for cx,cy,r,label in REGIONS]
+    with open(path,'w') as f:
+        json.dump(features,f)
+
+
+@pytest.fixture(scope='session')
+def slide_source(tmp_path_factory):
+    """
+    slide and annotation files written once per session
+    :return paths: (slide path,annotation path)
+    """
+    root=tmp_path_factory.mktemp('source')
+    slide_path=str(root/'slide1.tiff')
+    json_path=str(root/'slide1.json')
+    _write_slide(slide_path)
+    _write_qupath(json_path)
+    return slide_path, json_path
+
+
+@pytest.fixture
+def slide_files(slide_source, tmp_path):
+    """
+    private copy of the slide files so caches written next to the
+    slide do not leak between tests
+    :return paths: (slide path,annotation path)
+    """
+    paths=[]
+    for p in slide_source:
+        paths.append(str(tmp_path/os.path.basename(p)))
+        shutil.copy2(p,paths[-1])
+    return tuple(paths)
+
+
+@pytest.fixture
+def slide(slide_files):
+    from pyslide.slide import Slide
+    slide_path,json_path=slide_files
+    slide=Slide(slide_path,annotations_path=json_path,source='qupath')
+    slide.mpp=0.5
+    yield slide
+    slide.close()
+
+
+@pytest.fixture
+def edge_only():
+    """
+    check two class masks only differ on class boundaries. OpenCV
+    clips polygons crossing a buffer's border, which can move edge
+    pixels by one
+    """
+    def check(mask, expected):
+        assert mask.shape==expected.shape
+        kernel=np.ones((3,3),np.uint8)
+        boundary=cv2.dilate(expected,kernel)!=cv2.erode(expected,kernel)
+        assert not np.any((mask!=expected)&~boundary)
+    return check
+
+
+@pytest.fixture
+def border():
+    return [[0,WIDTH],[0,HEIGHT]]
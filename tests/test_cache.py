@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+import pytest
+from openslide import OpenSlide
+
+from pyslide.cache import SlideMeta
+from pyslide.mask import MaskPyramid, TissueMask
+from pyslide.util.fileio import atomic_write
+
+
+def _shared(mode, directory=False):
+    umask=os.umask(0)
+    os.umask(umask)
+    return mode&0o777==(0o777 if directory else 0o666)&~umask
+
+
+def _touch(path):
+    stat=os.stat(path)
+    os.utime(path,ns=(stat.st_atime_ns,stat.st_mtime_ns+10**9))
+
+
+def test_atomic_write_cleans_up(tmp_path):
+    path=str(tmp_path/'a.npy')
+    atomic_write(path,lambda f: np.save(f,np.arange(3)))
+    assert _shared(os.stat(path).st_mode)
+    def fail(f):
+        raise RuntimeError('dump failed')
+    with pytest.raises(RuntimeError):
+        atomic_write(str(tmp_path/'b.npy'),fail)
+    assert os.listdir(tmp_path)==['a.npy']
+
+
+@pytest.mark.parametrize('level',[0,2,4])
+def test_mask_pyramid_matches_rasterizer(slide, edge_only, tmp_path, level):
+    expected=slide.generate_mask_region(512,256,400,300,level)
+    pyramid=slide.build_mask_pyramid(str(tmp_path/'masks'),band=128)
+    region=slide.generate_mask_region(512,256,400,300,level)
+    #bands clip polygons like windows do
+    edge_only(region,expected)
+    path=pyramid._level_path(level)
+    assert _shared(os.stat(path).st_mode)
+    assert isinstance(pyramid.level(level),np.memmap)
+    assert os.listdir(os.path.dirname(path))==[f'level_{level}.npy']
+
+
+def test_mask_pyramid_key_changes_with_annotations(slide, tmp_path):
+    key=MaskPyramid(slide,str(tmp_path)).key
+    slide.annotations.filter_labels(['sinus'])
+    assert MaskPyramid(slide,str(tmp_path)).key!=key
+
+
+def test_slide_meta_matches_slide(slide_files):
+    slide_path,_=slide_files
+    meta=SlideMeta(slide_path)
+    slide=OpenSlide(slide_path)
+    assert meta.dimensions==slide.dimensions
+    assert meta.level_dimensions==slide.level_dimensions
+    assert meta.level_downsamples==slide.level_downsamples
+    thumbnail=np.array(slide.get_thumbnail(slide.level_dimensions[3]).convert('RGB'))
+    assert np.array_equal(meta.level_array(3),thumbnail)
+    assert _shared(os.stat(os.path.join(meta.dir,'meta.json')).st_mode)
+    assert _shared(os.stat(os.path.join(meta.dir,'level_3.npy')).st_mode)
+
+
+def test_slide_meta_reused_and_invalidated(slide_files):
+    slide_path,_=slide_files
+    SlideMeta(slide_path).level_array(3)
+    cached=SlideMeta(slide_path)
+    cached.level_array(3)
+    assert cached._slide is None
+    _touch(slide_path)
+    stale=SlideMeta(slide_path)
+    stale.dimensions
+    assert stale._slide is not None
+    assert not os.path.exists(os.path.join(stale.dir,'level_3.npy'))
+
+
+def test_tissue_mask_cache(slide):
+    tissue=TissueMask(slide,level=4)
+    assert os.path.basename(tissue.path)=='slide1_tissue_4.npz'
+    assert _shared(os.stat(tissue.path).st_mode)
+    assert 0<tissue.mask.mean()<255
+    mtime=os.stat(tissue.path).st_mtime_ns
+    assert np.array_equal(TissueMask(slide,level=4).mask,tissue.mask)
+    assert os.stat(tissue.path).st_mtime_ns==mtime
+
+
+def test_tissue_mask_rebuilt_when_stale(slide, monkeypatch):
+    path=TissueMask(slide,level=4).path
+    with np.load(path) as cached:
+        source=cached['source']
+    _touch(slide.path)
+    TissueMask(slide,level=4)
+    with np.load(path) as cached:
+        assert not np.array_equal(cached['source'],source)
+        params=str(cached['params'])
+    monkeypatch.setattr(TissueMask,'fill',200)
+    TissueMask(slide,level=4)
+    with np.load(path) as cached:
+        assert str(cached['params'])!=params
+
+
+def test_tissue_fractions_match_mask(slide):
+    tissue=TissueMask(slide,level=4)
+    d=int(tissue.downsample)
+    xs=np.array([0,256,512,1024])
+    ys=np.array([0,512,256,768])
+    fractions=tissue.fractions(xs,ys,256,256)
+    for f, x, y in zip(fractions,xs,ys):
+        block=tissue.mask[y//d:(y+256)//d,x//d:(x+256)//d]
+        assert f==pytest.approx((block>0).mean())
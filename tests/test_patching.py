@@ -0,0 +1,182 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from pyslide.patching import Patch
+from pyslide.analysis.filters import (batch_entropy, histogram_entropy,
+                                      entropy_agreement, patch_metrics)
+from pyslide.util.utilities import sample_cohort
+
+
+@pytest.fixture
+def patch(slide, border):
+    patch=Patch(slide,(128,128),mag_level=1,border=border)
+    patch.generate_patches(128)
+    return patch
+
+
+def _positions(patch):
+    df=patch.patches.df()
+    return list(zip(df.x,df.y))
+
+
+def test_integral_labels_match_mask_labels(patch):
+    patch.generate_labels(threshold=0.5,remove=False,method='integral')
+    integral=patch.patches.label.copy()
+    patch.generate_labels(threshold=0.5,remove=False,method='masks')
+    assert np.array_equal(integral,patch.patches.label,equal_nan=True)
+    assert set(np.unique(integral[~np.isnan(integral)]))=={0,1,2}
+
+
+def test_sample_is_deterministic(patch, slide, border):
+    patch.sample(20,seed=7)
+    first=_positions(patch)
+    again=Patch(slide,(128,128),mag_level=1,border=border)
+    again.generate_patches(128)
+    again.sample(20,seed=7)
+    assert _positions(again)==first
+    other=Patch(slide,(128,128),mag_level=1,border=border)
+    other.generate_patches(128)
+    other.sample(20,seed=8)
+    assert _positions(other)!=first
+
+
+@pytest.mark.parametrize('chunk',[7,100,2**16])
+def test_streamed_sample_matches_grid_sample(patch, slide, border, chunk):
+    patch.sample(20,seed=3)
+    streamed=Patch(slide,(128,128),mag_level=1,border=border)
+    streamed.sample(20,seed=3,step=128,chunk=chunk)
+    assert _positions(streamed)==_positions(patch)
+
+
+def test_stratified_sample(patch, slide, border):
+    with pytest.raises(ValueError):
+        patch.sample(3,stratify=True)
+    with pytest.raises(ValueError):
+        patch.sample({1.0:3},stratify=False)
+    patch.generate_labels(threshold=0.5)
+    patch.sample({1.0:3,2.0:2},seed=1,stratify=True)
+    labels=patch.patches.df().labels
+    assert (labels==1).sum()==3 and (labels==2).sum()==2 and len(labels)==5
+    streamed=Patch(slide,(128,128),mag_level=1,border=border)
+    streamed.sample({1.0:3,2.0:2},seed=1,stratify=True,step=128,chunk=50)
+    assert _positions(streamed)==_positions(patch)
+
+
+def test_sample_cohort(slide, border):
+    patches=[Patch(slide,(128,128),mag_level=1,border=border) for _ in range(2)]
+    for p in patches:
+        p.generate_patches(128)
+    table=sample_cohort(patches,5,seed=2)
+    assert len(table)==10
+    assert len(sample_cohort([],5))==0
+
+
+def test_extract_patches_modes_match_serial(patch):
+    serial=list(patch.extract_patches())
+    assert len(serial)==patch.number
+    expected={p['name']:image for image,p in serial}
+    names=[p['name'] for _,p in serial]
+    for kwargs in ({'threads':3},{'workers':2,'chunksize':5}):
+        out=list(patch.extract_patches(**kwargs))
+        assert [p['name'] for _,p in out]==names
+        assert all(np.array_equal(image,expected[p['name']]) for image,p in out)
+    out=list(patch.extract_patches(supertile=2**16))
+    assert sorted(p['name'] for _,p in out)==sorted(names)
+    assert all(np.array_equal(image,expected[p['name']]) for image,p in out)
+    one_band=list(patch.extract_patches(supertile=2**24))
+    assert [p['name'] for _,p in one_band]==names
+
+
+def test_extract_patch_reads_level(patch, slide):
+    image=patch.extract_patch(256,512)
+    expected=slide.read_region_array((256,512),1,(128,128))
+    assert np.array_equal(image,expected)
+
+
+def test_histogram_entropy_batch_matches_single(patch):
+    images=np.stack([image for image,_ in patch.extract_patches()][:20])
+    batch=batch_entropy(images,'histogram')
+    single=[histogram_entropy(image) for image in images]
+    assert np.allclose(batch,single)
+    assert (batch>=0).all() and (batch<=8).all()
+
+
+def test_entropy_agreement(patch):
+    images=np.stack([image for image,_ in patch.extract_patches()][::4])
+    report=entropy_agreement(images,threshold=2.0,method='histogram')
+    assert report['rank_correlation']>0.5
+    assert 0<=report['agreement']<=1
+
+
+def test_entropy_filter_methods(patch, slide, border):
+    images=np.stack([image for image,_ in patch.extract_patches()])
+    entropies=batch_entropy(images,'histogram')
+    threshold=float(np.median(entropies))
+    patch.filter_patches('entropy',threshold,method='histogram')
+    assert patch.number==int((entropies>=threshold).sum())
+
+
+def test_qc_threads_match_serial(patch, slide, border):
+    serial=patch.qc()
+    threaded=Patch(slide,(128,128),mag_level=1,border=border)
+    threaded.generate_patches(128)
+    assert threaded.qc(threads=3).equals(serial)
+    image,p=next(patch.extract_patches())
+    metrics=patch_metrics(image)
+    row=serial.iloc[0]
+    assert all(row[m]==pytest.approx(v) for m,v in metrics.items())
+
+
+def test_qc_filter(patch):
+    with pytest.raises(ValueError):
+        patch.qc_filter(background=(None,0.5))
+    df=patch.qc(metrics=['background','blur'])
+    removed=patch.qc_filter(background=(None,0.5),blur=(10,None))
+    keep=(df.background<=0.5)&(df.blur>=10)
+    assert removed==int((~keep).sum())
+    assert patch.number==int(keep.sum())
+
+
+def _images(path):
+    return {f:cv2.imread(os.path.join(path,f),cv2.IMREAD_UNCHANGED)
+            for f in sorted(os.listdir(path))}
+
+
+def test_save_features_and_workers(patch, tmp_path):
+    patch.sample(12,seed=0)
+    patch.save(str(tmp_path/'serial'),mask_flag=True,features=['GC','sinus'])
+    patch.save(str(tmp_path/'workers'),mask_flag=True,features=['GC','sinus'],
+               workers=2,chunksize=4)
+    for d in ('images','masks/GC','masks/sinus'):
+        serial=_images(str(tmp_path/'serial'/d))
+        workers=_images(str(tmp_path/'workers'/d))
+        assert len(serial)==12 and serial.keys()==workers.keys()
+        assert all(np.array_equal(serial[k],workers[k]) for k in serial)
+    for p in patch.patches:
+        masks=patch.extract_feature_masks(p['x'],p['y'],['GC','sinus'])
+        name=p['name']+'.png'
+        assert np.array_equal(_images(str(tmp_path/'serial/masks/GC'))[name],masks[0])
+        assert np.array_equal(_images(str(tmp_path/'serial/masks/sinus'))[name],masks[1])
+
+
+def test_save_context(patch, tmp_path):
+    patch.sample(6,seed=0)
+    patch.save(str(tmp_path),context=[4],threads=2)
+    contexts=_images(str(tmp_path/'context_4'))
+    for p in patch.patches:
+        images=patch.extract_context(p['x'],p['y'],(4,))
+        assert len(images)==2 and images[1].shape==(128,128,3)
+        #_save_disk swaps channels before cv2.imwrite
+        assert np.array_equal(contexts[p['name']+'.png'][...,::-1],images[1])
+
+
+def test_context_threads_match_serial(patch):
+    patch.sample(6,seed=0)
+    serial=list(patch.extract_contexts((2,4)))
+    threaded=list(patch.extract_contexts((2,4),threads=3))
+    assert [p['name'] for _,p in serial]==[p['name'] for _,p in threaded]
+    for (a,_),(b,_) in zip(serial,threaded):
+        assert all(np.array_equal(x,y) for x,y in zip(a,b))
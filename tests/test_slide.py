@@ -0,0 +1,137 @@
+import os
+
+import numpy as np
+import pytest
+
+from pyslide.slide import Annotations
+from pyslide.pool import SlidePool
+from pyslide.util.spatial import GridIndex
+
+
+WINDOWS=[(0,0,256,256),(400,450,512,384),(1024,512,300,200),
+         (1900,1400,256,256),(-64,-32,200,200)]
+
+
+def _crop(mask, x, y, w, h):
+    region=np.zeros((h,w),dtype=np.uint8)
+    x1,y1=max(x,0),max(y,0)
+    x2,y2=min(x+w,mask.shape[1]),min(y+h,mask.shape[0])
+    region[y1-y:y2-y,x1-x:x2-x]=mask[y1:y2,x1:x2]
+    return region
+
+
+@pytest.mark.parametrize('x,y,w,h',WINDOWS)
+def test_mask_region_matches_full_mask(slide, edge_only, x, y, w, h):
+    full=slide.generate_mask()
+    region=slide.generate_mask_region(x,y,w,h)
+    edge_only(region,_crop(full,x,y,w,h))
+    assert (region!=_crop(full,x,y,w,h)).mean()<0.001
+
+
+def test_mask_region_levels_cover_annotations(slide):
+    for level in range(slide.level_count):
+        w,h=slide.level_dimensions[level]
+        mask=slide.generate_mask_region(0,0,w,h,level)
+        assert mask.shape==(h,w)
+        assert set(np.unique(mask))=={0,1,2}
+
+
+def test_index_matches_brute_force(slide):
+    annotations=slide.annotations
+    bboxes=annotations.bboxes
+    rng=np.random.default_rng(1)
+    for _ in range(50):
+        x1,y1=rng.integers(-100,2000,2)
+        x2,y2=x1+rng.integers(1,600),y1+rng.integers(1,600)
+        hit=((bboxes[:,0]<=x2)&(bboxes[:,2]>=x1)
+             &(bboxes[:,1]<=y2)&(bboxes[:,3]>=y1))
+        assert np.array_equal(annotations.index.query(x1,y1,x2,y2),
+                              np.flatnonzero(hit))
+
+
+def test_index_cell_size_independent():
+    rng=np.random.default_rng(2)
+    xy=rng.integers(0,5000,(200,2))
+    bboxes=np.hstack((xy,xy+rng.integers(1,300,(200,2))))
+    small=GridIndex(bboxes,cell_size=64)
+    large=GridIndex(bboxes,cell_size=4096)
+    for x,y in rng.integers(0,5000,(50,2)):
+        assert np.array_equal(small.query(x,y,x+500,y+500),
+                              large.query(x,y,x+500,y+500))
+
+
+def test_label_at_matches_mask(slide):
+    full=slide.generate_mask()
+    labels=[None]+slide.annotations.labels
+    rng=np.random.default_rng(3)
+    for x,y in rng.integers(300,1400,(200,2)):
+        #points on a polygon edge may round either way
+        if slide.annotations.label_at(x,y)!=labels[full[y,x]]:
+            assert len(np.unique(full[y-1:y+2,x-1:x+2]))>1
+
+
+def test_feature_masks_match_mask(slide):
+    masks=slide.generate_feature_masks(0,0,1024,768,level=1)
+    mask=slide.generate_mask_region(0,0,1024,768,level=1)
+    assert masks.shape==(2,768,1024)
+    #sinus is drawn last in the multi-label mask
+    assert np.array_equal(masks[1]==1,mask==2)
+    assert np.all(masks[0][mask==1]==1)
+
+
+def test_read_region_array_matches_read_region(slide):
+    for level in range(3):
+        region=slide.read_region_array((256,512),level,(300,200))
+        expected=np.array(slide.read_region((256,512),level,(300,200)).convert('RGB'))
+        assert np.array_equal(region,expected)
+
+
+def test_read_regions_array_matches_single_reads(slide):
+    locations=[(0,0),(512,256),(1024,1024)]
+    regions=slide.read_regions_array(locations,1,(128,128),resize=(64,64))
+    for region, location in zip(regions,locations):
+        assert np.array_equal(region,slide.read_region_array(location,1,(128,128),
+                                                             resize=(64,64)))
+
+
+def test_region_cache_matches_uncached(slide):
+    expected=slide.read_region_array((512,256),0,(700,500))
+    slide.enable_region_cache(max_bytes=2**24,block=256)
+    assert np.array_equal(slide.read_region_array((512,256),0,(700,500)),expected)
+    misses=slide.cache_info['misses']
+    assert np.array_equal(slide.read_region_array((512,256),0,(700,500)),expected)
+    assert slide.cache_info['misses']==misses
+    assert slide.cache_info['hits']>0
+    assert slide.cache_info['bytes']<=2**24
+
+
+def test_annotation_cache(slide_files, tmp_path):
+    _,json_path=slide_files
+    cache_dir=str(tmp_path/'annotations')
+    parsed=Annotations(json_path,source='qupath',cache_dir=cache_dir)
+    cached=Annotations(json_path,source='qupath',cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir))==1
+    assert isinstance(cached._coords,np.memmap)
+    assert cached.labels==parsed.labels
+    for a in Annotations.CACHE_ARRAYS:
+        assert np.array_equal(getattr(cached,'_'+a),getattr(parsed,'_'+a))
+    entry=os.path.join(cache_dir,os.listdir(cache_dir)[0])
+    umask=os.umask(0)
+    os.umask(umask)
+    assert os.stat(entry).st_mode&0o777==0o777&~umask
+    os.utime(json_path,ns=(0,0))
+    Annotations(json_path,source='qupath',cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir))==2
+
+
+def test_pool_matches_slide(slide):
+    locations=[(x,y) for x in range(0,2048,512) for y in range(0,1536,512)]
+    with SlidePool(slide) as pool:
+        pooled=list(pool.imap(lambda l: (pool.read_region_mpp(l,1.0,(128,128)),
+                                         pool.generate_feature_masks(l[0],l[1],128,128,1)),
+                              locations,threads=4))
+        assert pool.dimensions==slide.dimensions
+        assert pool.read_region_array.__self__ is not slide
+    for (region, masks), l in zip(pooled,locations):
+        assert np.array_equal(region,slide.read_region_mpp(l,1.0,(128,128)))
+        assert np.array_equal(masks,slide.generate_feature_masks(l[0],l[1],128,128,1))
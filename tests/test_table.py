@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from pyslide.table import PatchTable
+
+
+@pytest.fixture
+def table():
+    return PatchTable([0,256,512,768],[0,0,256,256],'slide1',[1,np.nan,2,0])
+
+
+def test_filter_hides_rows(table):
+    assert table.filter([True,False,True,True])==1
+    assert len(table)==3
+    assert table.names==['slide1_0_0','slide1_512_256','slide1_768_256']
+    assert table.filter([False,True,True])==1
+    assert [r['x'] for r in table]==[512,768]
+    assert len(table.keep)==4
+
+
+def test_indexing_over_visible_rows(table):
+    table.filter([False,True,True,True])
+    assert table[0]['name']=='slide1_256_0'
+    assert np.array_equal(table[1:].x,[512,768])
+    assert np.array_equal(table[np.array([True,False,True])].x,[256,768])
+
+
+def test_rows_are_copies(table):
+    row=table[0]
+    row['label']=5
+    assert table.label[0]==1
+
+
+def test_set_column(table):
+    table.filter([True,False,True,True])
+    table.set_column('score',np.array([0.1,0.2,0.3]))
+    assert np.isnan(table.columns['score'][1])
+    assert np.array_equal(table.df()['score'],[0.1,0.2,0.3])
+
+
+def test_concat(table):
+    other=PatchTable([10,20],[30,40],['a','b'],[1,1])
+    table.filter([True,True,False,False])
+    both=PatchTable.concat([table,other])
+    assert both.names==['slide1_0_0','slide1_256_0','a_10_30','b_20_40']
+    assert both.slides==['a','b','slide1']
+    assert len(PatchTable.concat([]))==0
+
+
+def test_npz_round_trip(table, tmp_path):
+    table.filter([True,False,True,True])
+    table.set_column('score',np.array([0.1,0.2,0.3]))
+    path=str(tmp_path/'table.npz')
+    table.to_npz(path)
+    loaded=PatchTable.from_npz(path)
+    assert loaded.names==table.names
+    assert np.array_equal(loaded.keep,table.keep)
+    assert np.array_equal(loaded.columns['score'],table.columns['score'],equal_nan=True)
+
+
+def test_from_records(table):
+    rebuilt=PatchTable.from_records(list(table))
+    assert rebuilt.names==table.names
+    assert np.array_equal(rebuilt.label,table.label,equal_nan=True)
@@ -0,0 +1,23 @@
+import numpy as np
+import seaborn as sns
+
+from pyslide.util.utilities import mask2rgb
+
+
+def test_mask2rgb_palette():
+    mask=np.array([[0,1],[2,3]],dtype=np.uint8)
+    colors=np.array(sns.color_palette('hls',4))
+    rgb=mask2rgb(mask)
+    assert rgb.dtype==np.uint8
+    assert np.array_equal(rgb[0,0],[0,0,0])
+    assert np.array_equal(rgb[1,1],np.rint(colors[2]*255))
+    assert np.array_equal(mask2rgb(mask.astype(np.int64)),rgb)
+
+
+def test_mask2rgb_normalise():
+    mask=np.array([[0,1],[2,3]],dtype=np.uint8)
+    colors=np.array(sns.color_palette('hls',4))
+    rgb=mask2rgb(mask,normalise=True)
+    assert rgb.dtype==np.float64
+    assert np.array_equal(rgb[0,1],colors[0])
+    assert np.array_equal(rgb[1,1],colors[2])